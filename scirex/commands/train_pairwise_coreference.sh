@@ -7,7 +7,7 @@ fi
 export BERT_VOCAB=$BERT_BASE_FOLDER/vocab.txt
 export BERT_WEIGHTS=$BERT_BASE_FOLDER/weights.tar.gz
 
-export CONFIG_FILE=scirex/training_config/pairwise_coreference.jsonnet
+export CONFIG_FILE=${CONFIG_FILE:-scirex/training_config/pairwise_coreference.jsonnet}
 
 export CUDA_DEVICE=$CUDA_DEVICE
 
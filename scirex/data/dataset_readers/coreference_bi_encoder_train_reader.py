@@ -0,0 +1,45 @@
+from typing import Dict
+
+from allennlp.data.dataset_readers.dataset_reader import DatasetReader
+from allennlp.data.fields import Field, LabelField, MetadataField, TextField
+from allennlp.data.instance import Instance
+from allennlp.data.tokenizers import Token
+from overrides import overrides
+
+from scirex.data.dataset_readers.coreference_train_reader import ScirexCoreferenceTrainReader
+
+
+@DatasetReader.register("scirex_coreference_bi_encoder_train_reader")
+class ScirexCoreferenceBiEncoderTrainReader(ScirexCoreferenceTrainReader):
+    """
+    Same pairs as ScirexCoreferenceTrainReader, but premise and hypothesis are separate
+    [CLS] mention [SEP] fields, so each mention can be encoded on its own.
+    """
+
+    @overrides
+    def text_to_instance(
+        self,  # type: ignore
+        premise: str,
+        hypothesis: str,
+        label: int,
+        prob: float = None,
+    ) -> Instance:
+        fields: Dict[str, Field] = {}
+        premise_tokens = self._tokenizer.tokenize(premise)
+        hypothesis_tokens = self._tokenizer.tokenize(hypothesis)
+
+        fields["premise"] = TextField([Token("[CLS]")] + premise_tokens + [Token("[SEP]")], self._token_indexers)
+        fields["hypothesis"] = TextField(
+            [Token("[CLS]")] + hypothesis_tokens + [Token("[SEP]")], self._token_indexers
+        )
+
+        fields["label"] = LabelField(label, skip_indexing=True)
+
+        metadata = {
+            "premise_tokens": [x.text for x in premise_tokens],
+            "hypothesis_tokens": [x.text for x in hypothesis_tokens],
+            "keep_prob": prob,
+        }
+        fields["metadata"] = MetadataField(metadata)
+
+        return Instance(fields)
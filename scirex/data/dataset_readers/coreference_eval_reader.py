@@ -1,7 +1,8 @@
 import json
 import logging
+from collections import Counter, OrderedDict
 from itertools import combinations
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Iterator, List, Tuple
 
 from allennlp.data.dataset_readers.dataset_reader import DatasetReader
 from allennlp.data.fields import MetadataField, TextField
@@ -11,6 +12,10 @@ from allennlp.data.tokenizers import Token, Tokenizer
 from overrides import overrides
 from tqdm import tqdm
 
+from scirex.data.utils.lexical_cascade import ACCEPT, MODEL, REJECT, LexicalCascade
+from scirex.data.utils.mention_blocking import MentionBlocker
+from scirex_utilities.json_utilities import open_jsonl
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
@@ -21,6 +26,13 @@ class ScirexCoreferenceEvalReader(DatasetReader):
         tokenizer: Tokenizer = None,
         token_indexers: Dict[str, TokenIndexer] = None,
         lazy: bool = False,
+        deduplicate_pairs: bool = False,
+        mention_blocking: bool = False,
+        blocking_bands: int = 16,
+        blocking_rows: int = 2,
+        lexical_cascade: bool = False,
+        cascade_reject_threshold: float = 0.0,
+        cascade_accept_threshold: float = float("inf"),
     ) -> None:
         super().__init__(lazy)
         self._field = field
@@ -28,24 +40,164 @@ class ScirexCoreferenceEvalReader(DatasetReader):
         self._tokenizer = tokenizer
         self._token_indexers = token_indexers or {"tokens": SingleIdTokenIndexer()}
 
+        ## If True, mention pairs with identical model input are scored once.
+        ## Metadata of such an instance lists all of them under "pairs".
+        self._deduplicate_pairs = deduplicate_pairs
+        self._tokenized: Dict[str, List[Token]] = {}
+        # Pairs passing the type / string filter without and with mention blocking.
+        self._n_unblocked_pairs = 0
+        self._n_blocked_pairs = 0
+        # Pairs sent down each lexical cascade route.
+        self._route_counts: Counter = Counter()
+
+        ## If True, only mention pairs sharing a block (see MentionBlocker) are candidates.
+        self._blocker = MentionBlocker(blocking_bands, blocking_rows) if mention_blocking else None
+
+        ## If True, pairs decided from their strings alone (see LexicalCascade) get
+        ## metadata["cascade_score"] and should not be sent to the model.
+        self._cascade = (
+            LexicalCascade(accept_threshold=cascade_accept_threshold, reject_threshold=cascade_reject_threshold)
+            if lexical_cascade
+            else None
+        )
+
     @overrides
     def _read(self, file_path: str):
+        self.reset_pair_counts()
         pairs = self.generate_pairs(file_path)
+        self._tokenized = {}
 
         logger.info("Loaded all pairs from %s", file_path)
+        yield from self.pairs_to_instances(pairs)
+        self.log_pair_counts()
+
+    def read_documents(self, file_path: str) -> Iterator[Tuple[str, List[Instance]]]:
+        """
+        Streaming alternative to ``read``: yield (doc_id, instances) one document at a time, so
+        only the pairs of the current document are in memory. Pairs are deduplicated within
+        each document only.
+        """
+        self.reset_pair_counts()
+        for doc_id, pairs in self.generate_document_pairs(file_path):
+            self._tokenized = {}
+            yield doc_id, list(self.pairs_to_instances(pairs))
+
+        self.log_pair_counts()
+
+    def pairs_to_instances(self, pairs) -> Iterator[Instance]:
+        if self._cascade is not None and len(pairs) > 0:
+            self.route_pairs(pairs)
+
+        if self._deduplicate_pairs:
+            pairs = self.deduplicate_pairs(pairs)
+
         for p in pairs:
             yield self.text_to_instance(*p)
 
+    def _tokenize(self, text: str) -> List[Token]:
+        # Mention strings recur a lot within a file, tokenize each only once.
+        if text not in self._tokenized:
+            self._tokenized[text] = self._tokenizer.tokenize(text)
+        return self._tokenized[text]
+
+    def route_pairs(self, pairs):
+        # Premise and hypothesis are type + " " + mention words, the cascade looks at the words.
+        routes = self._cascade.route([(p.split(" ", 1)[1], h.split(" ", 1)[1]) for p, h, _ in pairs])
+        self._route_counts.update(routes)
+        for (_, _, metadata), route in zip(pairs, routes):
+            if route != MODEL:
+                metadata["cascade_score"] = self._cascade.route_scores[route]
+
+    def deduplicate_pairs(self, pairs):
+        """
+        Collapse pairs whose premise and hypothesis tokenize the same (the tokenizer does the
+        normalization, eg. lowercasing) into one pair. Its metadata keeps the metadata of every
+        mention pair it stands for under "pairs", so the score can be broadcast back.
+        """
+        unique_pairs = OrderedDict()
+        for premise, hypothesis, metadata in pairs:
+            key = (
+                tuple(t.text for t in self._tokenize(premise)),
+                tuple(t.text for t in self._tokenize(hypothesis)),
+                metadata.get("cascade_score"),
+            )
+            if key not in unique_pairs:
+                unique_metadata = {"field": metadata["field"], "pairs": []}
+                if "cascade_score" in metadata:
+                    unique_metadata["cascade_score"] = metadata["cascade_score"]
+                unique_pairs[key] = (premise, hypothesis, unique_metadata)
+            unique_pairs[key][2]["pairs"].append(metadata)
+
+        logger.debug("Collapsed %d mention pairs into %d unique pairs", len(pairs), len(unique_pairs))
+        return list(unique_pairs.values())
+
     def generate_pairs(self, file_path):
         pairs = []
-        with open(file_path, "r") as data_file:
+        for _, document_pairs in self.generate_document_pairs(file_path):
+            pairs += document_pairs
+
+        print(len(pairs))
+        return pairs
+
+    def reset_pair_counts(self):
+        self._n_unblocked_pairs = 0
+        self._n_blocked_pairs = 0
+        self._route_counts = Counter()
+
+    def log_pair_counts(self):
+        # One summary per read, the per-document counts are logged at debug.
+        if self._blocker is not None:
+            logger.info(
+                "Mention blocking kept %d of %d mention pairs (%d pruned)",
+                self._n_blocked_pairs,
+                self._n_unblocked_pairs,
+                self._n_unblocked_pairs - self._n_blocked_pairs,
+            )
+        if self._cascade is not None:
+            logger.info(
+                "Lexical cascade routes - accept : %d, reject : %d, model : %d",
+                self._route_counts[ACCEPT],
+                self._route_counts[REJECT],
+                self._route_counts[MODEL],
+            )
+
+    @staticmethod
+    def count_filtered_pairs(mentions: List[Tuple[str, str]]) -> int:
+        """
+        Number of (text, type) mention pairs passing the type / string filter of
+        generate_document_pairs without blocking, counted per group instead of over all pairs.
+        """
+
+        def n_pairs(counts):
+            return sum(n * (n - 1) // 2 for n in counts.values())
+
+        types, texts, both = Counter(), Counter(), Counter()
+        for text, mention_type in mentions:
+            types[mention_type] += 1
+            texts[text.lower()] += 1
+            both[(text.lower(), mention_type)] += 1
+
+        return n_pairs(types) + n_pairs(texts) - n_pairs(both)
+
+    def generate_document_pairs(self, file_path):
+        """Yield (doc_id, pairs) for each document of file_path, pairs as in generate_pairs."""
+        with open_jsonl(file_path, "r") as data_file:
             for line in tqdm(data_file):
                 ins = json.loads(line)
                 if self._field not in ins:
                     continue
                 entities: Tuple[int, int, str] = ins[self._field]
                 words = ins["words"]
-                for e1, e2 in combinations(entities, 2):
+                pairs = []
+
+                if self._blocker is not None:
+                    mentions = [(" ".join(words[e[0] : e[1]]), e[2]) for e in entities]
+                    n_unblocked = self.count_filtered_pairs(mentions)
+                    candidates = [(entities[i], entities[j]) for i, j in self._blocker.candidate_pairs(mentions)]
+                else:
+                    candidates = combinations(entities, 2)
+
+                for e1, e2 in candidates:
                     w1 = " ".join(words[e1[0] : e1[1]])
                     w2 = " ".join(words[e2[0] : e2[1]])
                     t1, t2 = e1[2], e2[2]
@@ -58,9 +210,20 @@ class ScirexCoreferenceEvalReader(DatasetReader):
                         }
                         pairs.append((t1 + " " + w1, t1 + " " + w2, metadata))
 
-        print(len(pairs))
+                if self._blocker is not None:
+                    self._n_unblocked_pairs += n_unblocked
+                    self._n_blocked_pairs += len(pairs)
+                    logger.debug(
+                        "Mention blocking kept %d of %d mention pairs in %s", len(pairs), n_unblocked, ins["doc_id"]
+                    )
 
-        return pairs
+                yield ins["doc_id"], pairs
+
+    def mention_to_instance(self, tokens: List[str]) -> Instance:
+        # Single mention input ([CLS] mention [SEP]) for bi-encoder models, tokens as in metadata.
+        return Instance(
+            {"tokens": TextField([Token("[CLS]")] + [Token(t) for t in tokens] + [Token("[SEP]")], self._token_indexers)}
+        )
 
     @overrides
     def text_to_instance(
@@ -71,8 +234,8 @@ class ScirexCoreferenceEvalReader(DatasetReader):
     ) -> Instance:
     
         fields = {}
-        premise_tokens = self._tokenizer.tokenize(premise)
-        hypothesis_tokens = self._tokenizer.tokenize(hypothesis)
+        premise_tokens = self._tokenize(premise)
+        hypothesis_tokens = self._tokenize(hypothesis)
 
         fields["tokens"] = TextField(
             [Token("[CLS]")] + premise_tokens + [Token("[SEP]")] + hypothesis_tokens, self._token_indexers
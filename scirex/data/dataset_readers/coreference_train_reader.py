@@ -11,6 +11,8 @@ from allennlp.data.token_indexers import SingleIdTokenIndexer, TokenIndexer
 from allennlp.data.tokenizers import Token, Tokenizer
 from overrides import overrides
 
+from scirex_utilities.json_utilities import open_jsonl
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
@@ -47,7 +49,7 @@ class ScirexCoreferenceTrainReader(DatasetReader):
     @staticmethod
     def generate_pairs(file_path):
         pairs = []
-        with open(file_path, "r") as data_file:
+        with open_jsonl(file_path, "r") as data_file:
             for _, line in enumerate(data_file):
                 ins = json.loads(line)
                 entities: List[Tuple[int, int, str]] = [tuple(x) for x in ins["ner"]]
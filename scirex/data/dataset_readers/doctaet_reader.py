@@ -10,6 +10,7 @@ from allennlp.data.token_indexers import TokenIndexer
 from allennlp.data.tokenizers import Token
 from overrides import overrides
 from scirex_utilities.entity_utils import used_entities
+from scirex_utilities.json_utilities import open_jsonl
 
 from scirex.data.utils.section_feature_extraction import filter_to_doctaet
 
@@ -61,7 +62,7 @@ class DoctaetReader(DatasetReader):
 
     @overrides
     def _read(self, file_path: str):
-        with open(file_path, "r") as g:
+        with open_jsonl(file_path, "r") as g:
             for _, line in enumerate(g):
                 json_dict = json.loads(line)
                 json_dict = clean_json_dict(json_dict)
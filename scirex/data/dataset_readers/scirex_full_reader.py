@@ -1,7 +1,9 @@
 import json
 from collections import OrderedDict
+from multiprocessing import Pool
 from typing import Any, Dict, List, Set, Tuple
 
+from allennlp.common.util import lazy_groups_of
 from allennlp.data.dataset_readers.dataset_reader import DatasetReader
 from allennlp.data.fields import (
     ListField,
@@ -16,10 +18,15 @@ from allennlp.data.token_indexers import TokenIndexer
 from allennlp.data.tokenizers import Token
 from overrides import overrides
 
+from scirex.data.utils.columnar_corpus import ColumnarCorpus, is_columnar_corpus
+from scirex.data.utils.document_cache import DocumentCache
+from scirex.data.utils.document_metadata import DocumentMetadata
+from scirex.data.utils.interval_index import IntervalIndex
 from scirex.data.utils.paragraph_alignment import *
 from scirex.data.utils.section_feature_extraction import extract_sentence_features
-from scirex.data.utils.span_utils import does_overlap, is_x_in_y, spans_to_bio_tags
+from scirex.data.utils.span_utils import spans_to_bio_tags
 from scirex_utilities.entity_utils import used_entities
+from scirex_utilities.json_utilities import open_jsonl
 
 from scipy.stats import mode
 
@@ -80,21 +87,19 @@ def clean_json_dict(json_dict):
     json_dict["coref"]: Dict[ClusterName, List[Span]] = clusters_dict
     json_dict["n_ary_relations"]: List[Dict[BaseEntityType, ClusterName]] = n_ary_relations
 
+    # Index construction checks that sentences don't overlap, so entity can lie in atmost one sentence.
+    sentence_index = IntervalIndex(json_dict["sentences"])
     for e in entities:
-        in_sentences = [
-            i for i, s in enumerate(json_dict["sentences"]) if is_x_in_y(e, s)
-        ]  # Check entity lie in one sentence
-        if len(in_sentences) > 1:
-            breakpoint()
-        if len(in_sentences) == 0:
-            in_sentences = [i for i, s in enumerate(json_dict["sentences"]) if does_overlap(e, s)]
-            assert sorted(in_sentences) == list(range(min(in_sentences), max(in_sentences) + 1)), breakpoint()
-            # breakpoint()
-            in_sentences = sorted(in_sentences)
+        if sentence_index.containing(e) is None:
+            # Entity crosses sentence boundary. Merge all sentences it overlaps.
+            in_sentences = sentence_index.overlapping(e)
+            assert len(in_sentences) > 0, breakpoint()
+            assert in_sentences == list(range(min(in_sentences), max(in_sentences) + 1)), breakpoint()
             json_dict["sentences"][in_sentences[0]][1] = json_dict["sentences"][in_sentences[-1]][1]
             json_dict["sentences"] = [
                 s for i, s in enumerate(json_dict["sentences"]) if i not in in_sentences[1:]
             ]
+            sentence_index = IntervalIndex(json_dict["sentences"])
 
     json_dict["sentences"]: List[List[Span]] = group_sentences_to_sections(
         json_dict["sentences"], json_dict["sections"]
@@ -109,8 +114,12 @@ def verify_json_dict(json_dict):
     entities: Dict[Span, str] = json_dict["ner"]
     corefs: Dict[str, List[Span]] = json_dict["coref"]
 
-    assert all(sum(is_x_in_y(e, s) for s in sections) == 1 for e in entities), breakpoint()
-    assert all(sum(is_x_in_y(e, ss) for s in sentences for ss in s) == 1 for e in entities), breakpoint()
+    # IntervalIndex asserts sections (and sentences) don't overlap, so finding one container means exactly one.
+    section_index = IntervalIndex(sections)
+    sentence_index = IntervalIndex([ss for s in sentences for ss in s])
+
+    assert all(section_index.containing(e) is not None for e in entities), breakpoint()
+    assert all(sentence_index.containing(e) is not None for e in entities), breakpoint()
     assert all(
         (sections[i][0] == sentences[i][0][0] and sections[i][-1] == sentences[i][-1][-1])
         for i in range(len(sections))
@@ -127,6 +136,9 @@ class ScirexFullReader(DatasetReader):
         max_paragraph_length: int = 300,
         lazy: bool = False,
         to_scirex_converter: bool = False,
+        document_cache_directory: str = None,
+        document_cache_size_mb: int = 10240,
+        num_workers: int = 0,
     ) -> None:
         super().__init__(lazy)
         self._token_indexers = token_indexers
@@ -137,109 +149,177 @@ class ScirexFullReader(DatasetReader):
         ## format to scierc format
         self.to_scierc_converter = to_scirex_converter
 
+        ## Preprocessed documents (everything before text_to_instance) are cached
+        ## on disk so repeated reads of the same file skip cleaning and alignment.
+        self._document_cache = (
+            DocumentCache(document_cache_directory, document_cache_size_mb)
+            if document_cache_directory is not None
+            else None
+        )
+
+        ## If > 1, documents are cleaned and preprocessed in a pool of worker processes.
+        ## Instances are still built here, in file order.
+        self._num_workers = num_workers
+
     @overrides
     def _read(self, file_path: str):
-        with open(file_path, "r") as g:
-            for _, line in enumerate(g):
-                json_dict = json.loads(line)
-                if self.prediction_mode:
-                    if "method_subrelations" in json_dict:
-                        del json_dict["method_subrelations"]
-                    json_dict["n_ary_relations"] = []
-                json_dict = clean_json_dict(json_dict)
-
-                verify_json_dict(json_dict)
-
-                # Get fields from JSON dict
-                doc_id = json_dict["doc_id"]
-                sections: List[Span] = json_dict["sections"]
-                sentences: List[List[Span]] = json_dict["sentences"]
-                words: List[str] = json_dict["words"]
-                entities: Dict[Span, EntityType] = json_dict["ner"]
-                corefs: Dict[ClusterName, List[Span]] = json_dict["coref"]
-                n_ary_relations: List[Dict[BaseEntityType, ClusterName]] = json_dict["n_ary_relations"]
-
-                # Extract Document structure features
-                entities_to_features_map: Dict[Span, List[str]] = extract_sentence_features(
-                    sentences, words, entities
-                )
+        for document in self._read_documents(file_path):
+            yield from self.document_to_instances(document)
 
-                # Map cluster names to integer cluster ids
-                cluster_name_to_id: Dict[ClusterName, int] = {
-                    k: i for i, k in enumerate(sorted(list(corefs.keys())))
-                }
-                max_salient_cluster = len(corefs)
-
-                # Map Spans to list of clusters ids it belong to.
-                span_to_cluster_ids: Dict[Span, List[int]] = {}
-                for cluster_name in corefs:
-                    for span in corefs[cluster_name]:
-                        span_to_cluster_ids.setdefault(span, []).append(cluster_name_to_id[cluster_name])
-
-                span_to_cluster_ids = {span: sorted(v) for span, v in span_to_cluster_ids.items()}
-
-                assert sorted(list(cluster_name_to_id.values())) == list(
-                    range(max_salient_cluster)
-                ), breakpoint()
-
-                # Map types to list of cluster ids that are of that type
-                type_to_cluster_ids: Dict[BaseEntityType, List[int]] = {k: [] for k in used_entities}
-
-                for cluster_name in corefs:
-                    types = [entities[span][0] for span in corefs[cluster_name]]
-                    if len(set(types)) > 0:
-                        try :
-                            type_to_cluster_ids[mode(types)[0][0]].append(cluster_name_to_id[cluster_name])
-                        except :
-                            # SciERC gives trouble here. Not relevant .
-                            continue
-
-                # Map relations to list of cluster ids in it.
-                relation_to_cluster_ids: Dict[int, List[int]] = {}
-                for rel_idx, rel in enumerate(n_ary_relations):
-                    relation_to_cluster_ids[rel_idx] = []
-                    for entity in used_entities:
-                        relation_to_cluster_ids[rel_idx].append(cluster_name_to_id[rel[entity]])
-                        type_to_cluster_ids[entity].append(cluster_name_to_id[rel[entity]])
-
-                    relation_to_cluster_ids[rel_idx] = tuple(relation_to_cluster_ids[rel_idx])
-
-                for k in type_to_cluster_ids:
-                    type_to_cluster_ids[k] = sorted(list(set(type_to_cluster_ids[k])))
-
-                # Move paragraph boundaries around to accomodate in BERT
-                sections, sentences_grouped, entities_grouped = self.resize_sections_and_group(
-                    sections, sentences, entities
-                )
+    def _read_documents(self, file_path: str):
+        if self._document_cache is None:
+            yield from self._preprocess_file(file_path)
+            return
 
-                document_metadata = {
-                    "cluster_name_to_id": cluster_name_to_id,
-                    "span_to_cluster_ids": span_to_cluster_ids,
-                    "relation_to_cluster_ids": relation_to_cluster_ids,
-                    "type_to_cluster_ids": type_to_cluster_ids,
-                    "doc_id": doc_id,
-                    "doc_length": len(words),
-                    "entities_to_features_map": entities_to_features_map,
-                }
-
-                # Loop over the sections.
-                for (paragraph_num, ((start_ix, end_ix), sentences, ner_dict)) in enumerate(
-                    zip(sections, sentences_grouped, entities_grouped)
-                ):
-                    paragraph = words[start_ix:end_ix]
-                    if len(paragraph) == 0:
-                        breakpoint()
-
-                    instance = self.text_to_instance(
-                        paragraph_num=paragraph_num,
-                        paragraph=paragraph,
-                        ner_dict=ner_dict,
-                        start_ix=start_ix,
-                        end_ix=end_ix,
-                        sentence_indices=sentences,
-                        document_metadata=document_metadata,
-                    )
-                    yield instance
+        key = self._document_cache.key(
+            file_path,
+            {"max_paragraph_length": self._max_paragraph_length, "prediction_mode": self.prediction_mode},
+        )
+        documents = self._document_cache.read(key)
+        if documents is None:
+            documents = self._document_cache.write_through(key, self._preprocess_file(file_path))
+
+        yield from documents
+
+    def _preprocess_file(self, file_path: str):
+        ## file_path can also be a columnar corpus directory (see scirex.data.utils.columnar_corpus).
+        if is_columnar_corpus(file_path):
+            documents = ColumnarCorpus(file_path).values()
+            if self._num_workers > 1:
+                yield from self._preprocess_in_pool(documents, _preprocess_json_dict)
+            else:
+                for json_dict in documents:
+                    yield self.preprocess_document(json_dict)
+            return
+
+        with open_jsonl(file_path, "r") as g:
+            if self._num_workers > 1:
+                yield from self._preprocess_in_pool(g, _preprocess_line)
+            else:
+                for _, line in enumerate(g):
+                    yield self.preprocess_document(json.loads(line))
+
+    def _preprocess_in_pool(self, items, preprocess_function):
+        # Items are sent to the pool in windows, keeping one window in flight while the
+        # previous one is consumed. This keeps memory bounded and preserves file order.
+        window_size = self._num_workers * 4
+        with Pool(
+            self._num_workers,
+            initializer=_init_preprocessing_worker,
+            initargs=(self._max_paragraph_length, self.prediction_mode),
+        ) as pool:
+            pending = None
+            for window in lazy_groups_of(iter(items), window_size):
+                result = pool.map_async(preprocess_function, window)
+                if pending is not None:
+                    yield from pending.get()
+                pending = result
+
+            if pending is not None:
+                yield from pending.get()
+
+    def preprocess_document(self, json_dict: Dict[str, Any]) -> Dict[str, Any]:
+        if self.prediction_mode:
+            if "method_subrelations" in json_dict:
+                del json_dict["method_subrelations"]
+            json_dict["n_ary_relations"] = []
+        json_dict = clean_json_dict(json_dict)
+
+        verify_json_dict(json_dict)
+
+        # Get fields from JSON dict
+        doc_id = json_dict["doc_id"]
+        sections: List[Span] = json_dict["sections"]
+        sentences: List[List[Span]] = json_dict["sentences"]
+        words: List[str] = json_dict["words"]
+        entities: Dict[Span, EntityType] = json_dict["ner"]
+        corefs: Dict[ClusterName, List[Span]] = json_dict["coref"]
+        n_ary_relations: List[Dict[BaseEntityType, ClusterName]] = json_dict["n_ary_relations"]
+
+        # Extract Document structure features
+        entities_to_features_map: Dict[Span, List[str]] = extract_sentence_features(sentences, words, entities)
+
+        # Map cluster names to integer cluster ids
+        cluster_name_to_id: Dict[ClusterName, int] = {k: i for i, k in enumerate(sorted(list(corefs.keys())))}
+        max_salient_cluster = len(corefs)
+
+        # Map Spans to list of clusters ids it belong to.
+        span_to_cluster_ids: Dict[Span, List[int]] = {}
+        for cluster_name in corefs:
+            for span in corefs[cluster_name]:
+                span_to_cluster_ids.setdefault(span, []).append(cluster_name_to_id[cluster_name])
+
+        span_to_cluster_ids = {span: sorted(v) for span, v in span_to_cluster_ids.items()}
+
+        assert sorted(list(cluster_name_to_id.values())) == list(range(max_salient_cluster)), breakpoint()
+
+        # Map types to list of cluster ids that are of that type
+        type_to_cluster_ids: Dict[BaseEntityType, List[int]] = {k: [] for k in used_entities}
+
+        for cluster_name in corefs:
+            types = [entities[span][0] for span in corefs[cluster_name]]
+            if len(set(types)) > 0:
+                try :
+                    type_to_cluster_ids[mode(types)[0][0]].append(cluster_name_to_id[cluster_name])
+                except :
+                    # SciERC gives trouble here. Not relevant .
+                    continue
+
+        # Map relations to list of cluster ids in it.
+        relation_to_cluster_ids: Dict[int, List[int]] = {}
+        for rel_idx, rel in enumerate(n_ary_relations):
+            relation_to_cluster_ids[rel_idx] = []
+            for entity in used_entities:
+                relation_to_cluster_ids[rel_idx].append(cluster_name_to_id[rel[entity]])
+                type_to_cluster_ids[entity].append(cluster_name_to_id[rel[entity]])
+
+            relation_to_cluster_ids[rel_idx] = tuple(relation_to_cluster_ids[rel_idx])
+
+        for k in type_to_cluster_ids:
+            type_to_cluster_ids[k] = sorted(list(set(type_to_cluster_ids[k])))
+
+        # Move paragraph boundaries around to accomodate in BERT
+        sections, sentences_grouped, entities_grouped = self.resize_sections_and_group(sections, sentences, entities)
+
+        # One copy per document, referenced (not copied) by every paragraph instance.
+        document_metadata = DocumentMetadata(
+            doc_id=doc_id,
+            words=words,
+            cluster_name_to_id=cluster_name_to_id,
+            span_to_cluster_ids=span_to_cluster_ids,
+            relation_to_cluster_ids=relation_to_cluster_ids,
+            type_to_cluster_ids=type_to_cluster_ids,
+            entities_to_features_map=entities_to_features_map,
+        )
+
+        return {
+            "sections": sections,
+            "sentences_grouped": sentences_grouped,
+            "entities_grouped": entities_grouped,
+            "document_metadata": document_metadata,
+        }
+
+    def document_to_instances(self, document: Dict[str, Any]):
+        words = document["document_metadata"].words
+
+        # Loop over the sections.
+        for (paragraph_num, ((start_ix, end_ix), sentences, ner_dict)) in enumerate(
+            zip(document["sections"], document["sentences_grouped"], document["entities_grouped"])
+        ):
+            paragraph = words[start_ix:end_ix]
+            if len(paragraph) == 0:
+                breakpoint()
+
+            instance = self.text_to_instance(
+                paragraph_num=paragraph_num,
+                paragraph=paragraph,
+                ner_dict=ner_dict,
+                start_ix=start_ix,
+                end_ix=end_ix,
+                sentence_indices=sentences,
+                document_metadata=document["document_metadata"],
+            )
+            yield instance
 
     def resize_sections_and_group(
         self, sections: List[Span], sentences: List[List[Span]], entities: Dict[Span, EntityType]
@@ -261,14 +341,11 @@ class ScirexFullReader(DatasetReader):
         sentences_grouped = [[] for _ in range(len(sections))]
 
         # Bert is PITA. Group entities into sections they belong to.
+        section_index = IntervalIndex(sections)
         for e in entities:
-            is_in_n_para = 0
-            for para_id, p in enumerate(sections):
-                if is_x_in_y(e, p):
-                    entities_grouped[para_id][(e[0], e[1])] = entities[e]
-                    is_in_n_para += 1
-
-            assert is_in_n_para == 1, breakpoint()
+            para_id = section_index.containing(e)
+            assert para_id is not None, breakpoint()
+            entities_grouped[para_id][(e[0], e[1])] = entities[e]
 
         ## Bert is serious PITA. Need to align sentences with sections also.
         sentences = [sent for section in sentences for sent in section]
@@ -277,13 +354,9 @@ class ScirexFullReader(DatasetReader):
         sentence_indices = sorted(list(set([0] + [s[1] for s in sentences] + [s[1] for s in sections])))
         sentences = list(zip(sentence_indices[:-1], sentence_indices[1:]))
         for e in sentences:
-            is_in_n_para = 0
-            for para_id, p in enumerate(sections):
-                if is_x_in_y(e, p):
-                    sentences_grouped[para_id].append(e)
-                    is_in_n_para += 1
-
-            assert is_in_n_para == 1, breakpoint()
+            para_id = section_index.containing(e)
+            assert para_id is not None, breakpoint()
+            sentences_grouped[para_id].append(e)
 
         zipped = zip(sections, sentences_grouped, entities_grouped)
 
@@ -308,7 +381,7 @@ class ScirexFullReader(DatasetReader):
         start_ix: int,
         end_ix: int,
         sentence_indices: List[Span],
-        document_metadata: Dict[str, Any],
+        document_metadata: DocumentMetadata,
     ):
 
         if self.to_scierc_converter:
@@ -328,7 +401,6 @@ class ScirexFullReader(DatasetReader):
             dict(
                 doc_id=document_metadata["doc_id"],
                 paragraph_num=paragraph_num,
-                paragraph=paragraph,
                 start_pos_in_doc=start_ix,
                 end_pos_in_doc=end_ix,
                 ner_dict=ner_dict,
@@ -420,3 +492,21 @@ class ScirexFullReader(DatasetReader):
             )
 
         return Instance(fields)
+
+
+## Each worker process keeps its own reader to run preprocess_document.
+_worker_reader: ScirexFullReader = None
+
+
+def _init_preprocessing_worker(max_paragraph_length: int, prediction_mode: bool):
+    global _worker_reader
+    _worker_reader = ScirexFullReader(max_paragraph_length=max_paragraph_length)
+    _worker_reader.prediction_mode = prediction_mode
+
+
+def _preprocess_line(line: str) -> Dict[str, Any]:
+    return _worker_reader.preprocess_document(json.loads(line))
+
+
+def _preprocess_json_dict(json_dict: Dict[str, Any]) -> Dict[str, Any]:
+    return _worker_reader.preprocess_document(json_dict)
@@ -8,6 +8,7 @@ from overrides import overrides
 from allennlp.common.checks import ConfigurationError
 from allennlp.common.util import lazy_groups_of, add_noise_to_dict_values
 from allennlp.data.dataset import Batch
+from allennlp.data.fields import TextField
 from allennlp.data.instance import Instance
 from allennlp.data.iterators.data_iterator import DataIterator
 from allennlp.data.vocabulary import Vocabulary
@@ -82,6 +83,11 @@ class BucketSampleIterator(DataIterator):
         See :class:`BasicIterator`.
     maximum_samples_per_batch : ``Tuple[str, int]``, (default = None)
         See :class:`BasicIterator`.
+    max_tokens_per_batch : int, optional, (default = None)
+        If given, instances are sorted by length (longest text field, in wordpieces for bert
+        indexers) and packed into batches whose padded size (number of instances times the
+        longest instance) stays within this many tokens. ``batch_size`` then caps the number of
+        instances per batch, so short instances do not pack into huge batches.
     """
 
     def __init__(self,
@@ -93,7 +99,8 @@ class BucketSampleIterator(DataIterator):
                  max_instances_in_memory: int = None,
                  cache_instances: bool = False,
                  track_epoch: bool = False,
-                 maximum_samples_per_batch: Tuple[str, int] = None) -> None:
+                 maximum_samples_per_batch: Tuple[str, int] = None,
+                 max_tokens_per_batch: int = None) -> None:
 
         super().__init__(cache_instances=cache_instances,
                          track_epoch=track_epoch,
@@ -104,6 +111,40 @@ class BucketSampleIterator(DataIterator):
         self._sorting_keys = sorting_keys
         self._padding_noise = padding_noise
         self._biggest_batch_first = biggest_batch_first
+        self._max_tokens_per_batch = max_tokens_per_batch
+
+    def _instance_length(self, instance: Instance) -> float:
+        instance.index_fields(self.vocab)
+        lengths = [
+            max(field.get_padding_lengths().values())
+            for field in instance.fields.values()
+            if isinstance(field, TextField)
+        ]
+        return max(lengths) if len(lengths) > 0 else 0
+
+    def _token_budget_batches(self, instances: List[Instance]) -> List[Batch]:
+        lengths = [self._instance_length(instance) for instance in instances]
+        if self._padding_noise > 0.0:
+            noisy = [length * (1 + random.uniform(-self._padding_noise, self._padding_noise)) for length in lengths]
+        else:
+            noisy = lengths
+        order = sorted(range(len(instances)), key=lambda i: noisy[i])
+
+        batches = []
+        batch_instances: List[Instance] = []
+        batch_length = 0
+        for i in order:
+            new_length = max(batch_length, lengths[i])
+            over_budget = (len(batch_instances) + 1) * new_length > self._max_tokens_per_batch
+            if len(batch_instances) > 0 and (over_budget or len(batch_instances) >= self._batch_size):
+                batches.append(Batch(batch_instances))
+                batch_instances, new_length = [], lengths[i]
+            batch_instances.append(instances[i])
+            batch_length = new_length
+        if batch_instances:
+            batches.append(Batch(batch_instances))
+
+        return batches
 
     @overrides
     def _create_batches(self, instances: Iterable[Instance], shuffle: bool) -> Iterable[Batch]:
@@ -116,15 +157,16 @@ class BucketSampleIterator(DataIterator):
                                                 self.vocab,
                                                 self._padding_noise)
 
-            
-
-            batches = []
-            excess: Deque[Instance] = deque()
-            for batch_instances in lazy_groups_of(iter(instance_list), self._batch_size):
-                for possibly_smaller_batches in self._ensure_batch_is_sufficiently_small(batch_instances, excess):
-                    batches.append(Batch(possibly_smaller_batches))
-            if excess:
-                batches.append(Batch(excess))
+            if self._max_tokens_per_batch is not None:
+                batches = self._token_budget_batches(instance_list)
+            else:
+                batches = []
+                excess: Deque[Instance] = deque()
+                for batch_instances in lazy_groups_of(iter(instance_list), self._batch_size):
+                    for possibly_smaller_batches in self._ensure_batch_is_sufficiently_small(batch_instances, excess):
+                        batches.append(Batch(possibly_smaller_batches))
+                if excess:
+                    batches.append(Batch(excess))
 
             # TODO(brendanr): Add multi-GPU friendly grouping, i.e. group
             # num_gpu batches together, shuffle and then expand the groups.
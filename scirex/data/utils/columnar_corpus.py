@@ -0,0 +1,218 @@
+"""
+Columnar on disk format for SciREX corpora (``release_data/*.jsonl`` and prediction files).
+
+A corpus is a directory of flat binary columns that are memory-mapped on open:
+
+    strings.bin / string_offsets.bin    utf-8 blob of all interned strings (words, labels, cluster names)
+    doc_ids.bin                         string id of each document's doc_id
+    words.bin                           string id of each word
+    sentences.bin, sections.bin         int32 (start, end) rows
+    ner.bin                             int32 (start, end, label string id) rows
+    coref.bin                           int32 (cluster name string id, number of spans) rows
+    coref_spans.bin                     int32 (start, end) rows, the spans of each cluster in order
+    extras.bin                          json of the remaining fields (n_ary_relations, method_subrelations ...)
+
+Only ``doc_id`` is required. Prediction files (eg. ``ner`` without ``sections``, or
+``spans`` / ``clusters`` without ``words``) convert too: absent columns are stored empty and
+listed under ``__absent__`` in the document's extras, so they are left out again on read.
+Fields outside the columns (such as ``clusters``) go to extras as json.
+
+Every column ``c`` has a ``c_offsets.bin`` int64 array with the row range of each document,
+so opening the corpus only reads ``meta.json`` and the doc_id index, and a single document is
+rebuilt from slices of the mapped arrays without parsing the whole file.
+
+Convert with ``python -m scirex.data.utils.columnar_corpus --input_file x.jsonl --output_dir x``.
+"""
+import argparse
+import json
+import os
+from typing import Any, Dict, Iterator, List, Mapping
+
+import numpy as np
+
+from scirex_utilities.json_utilities import open_jsonl
+
+COLUMNAR_FORMAT_VERSION = 1
+
+# name -> number of int32 values per row
+COLUMN_WIDTHS = {"words": 1, "sentences": 2, "sections": 2, "ner": 3, "coref": 2, "coref_spans": 2}
+COLUMN_FIELDS = ["doc_id", "words", "sentences", "sections", "ner", "coref"]
+
+
+def is_columnar_corpus(path: str) -> bool:
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "meta.json"))
+
+
+class _ColumnWriter:
+    def __init__(self, path: str, dtype) -> None:
+        self._file = open(path, "wb")
+        self._dtype = dtype
+        self._size = 0
+        self.offsets = [0]
+
+    def append(self, rows) -> None:
+        rows = np.asarray(rows, dtype=self._dtype)
+        rows.tofile(self._file)
+        self._size += len(rows)
+
+    def end_document(self) -> None:
+        self.offsets.append(self._size)
+
+    def close(self, offsets_path: str = None) -> None:
+        self._file.close()
+        if offsets_path is not None:
+            np.asarray(self.offsets, dtype=np.int64).tofile(offsets_path)
+
+
+def write_columnar_corpus(documents: Iterator[Dict[str, Any]], output_dir: str) -> int:
+    """
+    Write SciREX json documents to ``output_dir`` in the columnar format. Documents are
+    streamed, only the string table is kept in memory. Returns the number of documents.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    path = lambda name: os.path.join(output_dir, name)
+
+    string_to_id: Dict[str, int] = {}
+    strings = _ColumnWriter(path("strings.bin"), np.uint8)
+
+    def intern(string: str) -> int:
+        if string not in string_to_id:
+            string_to_id[string] = len(string_to_id)
+            strings.append(np.frombuffer(string.encode("utf-8"), dtype=np.uint8))
+            strings.end_document()
+        return string_to_id[string]
+
+    doc_ids = _ColumnWriter(path("doc_ids.bin"), np.int32)
+    columns = {name: _ColumnWriter(path(name + ".bin"), np.int32) for name in COLUMN_WIDTHS}
+    extras = _ColumnWriter(path("extras.bin"), np.uint8)
+
+    n_docs = 0
+    for document in documents:
+        doc_ids.append([intern(document["doc_id"])])
+
+        columns["words"].append([intern(w) for w in document.get("words", [])])
+        columns["sentences"].append(np.reshape(document.get("sentences", []), (-1, 2)))
+        columns["sections"].append(np.reshape(document.get("sections", []), (-1, 2)))
+        columns["ner"].append(np.reshape([(s, e, intern(t)) for s, e, t in document.get("ner", [])], (-1, 3)))
+
+        coref = document.get("coref", {})
+        columns["coref"].append(np.reshape([(intern(k), len(v)) for k, v in coref.items()], (-1, 2)))
+        columns["coref_spans"].append(np.reshape([span for v in coref.values() for span in v], (-1, 2)))
+
+        remaining = {k: v for k, v in document.items() if k not in COLUMN_FIELDS}
+        absent = [k for k in COLUMN_FIELDS if k not in document]
+        if len(absent) > 0:
+            remaining["__absent__"] = absent
+        extras.append(np.frombuffer(json.dumps(remaining).encode("utf-8"), dtype=np.uint8))
+
+        for column in columns.values():
+            column.end_document()
+        extras.end_document()
+        n_docs += 1
+
+    strings.close(path("string_offsets.bin"))
+    doc_ids.close()
+    for name, column in columns.items():
+        column.close(path(name + "_offsets.bin"))
+    extras.close(path("extras_offsets.bin"))
+
+    with open(path("meta.json"), "w") as f:
+        json.dump({"version": COLUMNAR_FORMAT_VERSION, "num_documents": n_docs, "num_strings": len(string_to_id)}, f)
+
+    return n_docs
+
+
+def _map(path: str, dtype, width: int = 1) -> np.ndarray:
+    # np.memmap refuses empty files (eg. a corpus without any coref).
+    if os.path.getsize(path) == 0:
+        return np.zeros((0, width) if width > 1 else (0,), dtype=dtype)
+    array = np.memmap(path, dtype=dtype, mode="r")
+    return array.reshape(-1, width) if width > 1 else array
+
+
+class ColumnarCorpus(Mapping):
+    """
+    Read only ``{doc_id: document}`` view of a columnar corpus directory. Documents are
+    returned as the same dicts ``json.loads`` gives for the jsonl line they came from.
+    """
+
+    def __init__(self, corpus_dir: str) -> None:
+        path = lambda name: os.path.join(corpus_dir, name)
+        with open(path("meta.json")) as f:
+            meta = json.load(f)
+        assert meta["version"] == COLUMNAR_FORMAT_VERSION, breakpoint()
+
+        self._strings = _map(path("strings.bin"), np.uint8)
+        self._string_offsets = _map(path("string_offsets.bin"), np.int64)
+        self._columns = {name: _map(path(name + ".bin"), np.int32, width) for name, width in COLUMN_WIDTHS.items()}
+        self._offsets = {name: _map(path(name + "_offsets.bin"), np.int64) for name in COLUMN_WIDTHS}
+        self._extras = _map(path("extras.bin"), np.uint8)
+        self._extras_offsets = _map(path("extras_offsets.bin"), np.int64)
+
+        self._doc_ids: List[str] = [self.string(i) for i in _map(path("doc_ids.bin"), np.int32).tolist()]
+        self._doc_id_to_index = {doc_id: i for i, doc_id in enumerate(self._doc_ids)}
+        # Duplicate doc_ids would make the index ambiguous.
+        assert len(self._doc_id_to_index) == meta["num_documents"], breakpoint()
+
+    def string(self, string_id: int) -> str:
+        start, end = self._string_offsets[string_id], self._string_offsets[string_id + 1]
+        return self._strings[start:end].tobytes().decode("utf-8")
+
+    def _rows(self, name: str, index: int) -> np.ndarray:
+        offsets = self._offsets[name]
+        return self._columns[name][offsets[index] : offsets[index + 1]]
+
+    def word_ids(self, doc_id: str) -> np.ndarray:
+        """Memory-mapped string ids of the words of a document, without decoding them."""
+        return self._rows("words", self._doc_id_to_index[doc_id])
+
+    def __getitem__(self, doc_id: str) -> Dict[str, Any]:
+        index = self._doc_id_to_index[doc_id]
+        strings = {i: self.string(i) for i in set(self._rows("words", index).tolist())}
+
+        coref: Dict[str, List[List[int]]] = {}
+        coref_spans = self._rows("coref_spans", index).tolist()
+        start = 0
+        for name_id, n_spans in self._rows("coref", index).tolist():
+            coref[self.string(name_id)] = coref_spans[start : start + n_spans]
+            start += n_spans
+
+        extras = self._extras[self._extras_offsets[index] : self._extras_offsets[index + 1]]
+        document = json.loads(extras.tobytes().decode("utf-8"))
+        document.update(
+            doc_id=doc_id,
+            words=[strings[i] for i in self._rows("words", index).tolist()],
+            sentences=self._rows("sentences", index).tolist(),
+            sections=self._rows("sections", index).tolist(),
+            ner=[[s, e, self.string(t)] for s, e, t in self._rows("ner", index).tolist()],
+            coref=coref,
+        )
+        for field in document.pop("__absent__", []):
+            del document[field]
+        return document
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._doc_ids)
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+
+def read_documents(path: str) -> Iterator[Dict[str, Any]]:
+    """Stream SciREX documents from either a jsonl file or a columnar corpus directory."""
+    if is_columnar_corpus(path):
+        yield from ColumnarCorpus(path).values()
+    else:
+        with open_jsonl(path) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    args = parser.parse_args()
+
+    n_docs = write_columnar_corpus(read_documents(args.input_file), args.output_dir)
+    print("Wrote %d documents to %s" % (n_docs, args.output_dir))
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# Bump when the layout of cached documents changes so stale entries are never read back.
+CACHE_FORMAT_VERSION = 2
+
+
+def hash_file_content(file_path: str, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha1()
+    # A directory (eg. a columnar corpus) hashes as the names and contents of its files.
+    if os.path.isdir(file_path):
+        paths = [os.path.join(file_path, name) for name in sorted(os.listdir(file_path))]
+    else:
+        paths = [file_path]
+
+    for path in paths:
+        if len(paths) > 1:
+            sha.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_signature(file_path: str) -> list:
+    # (name, size, mtime_ns) of the file, or of every file of a directory.
+    if os.path.isdir(file_path):
+        paths = [os.path.join(file_path, name) for name in sorted(os.listdir(file_path))]
+    else:
+        paths = [file_path]
+    return [[os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in paths]
+
+
+class DocumentCache:
+    """
+    On disk cache of per document preprocessing results of a dataset reader.
+
+    There is one cache file per (input file content, reader config) key. It contains
+    the pickled documents one after another, in the same order as the input file, so
+    reading it back streams exactly like reading the jsonl. Least recently used files are
+    evicted once the cache directory grows past ``max_size_mb``.
+    """
+
+    def __init__(self, cache_directory: str, max_size_mb: int = 10240) -> None:
+        self._cache_directory = cache_directory
+        self._max_size_bytes = max_size_mb * 1024 * 1024
+        os.makedirs(cache_directory, exist_ok=True)
+
+    def content_hash(self, file_path: str) -> str:
+        """
+        ``hash_file_content`` of file_path, remembered in the cache directory by absolute path
+        together with the size and mtime of the file(s). The content is only hashed again
+        when those change.
+        """
+        index_path = os.path.join(self._cache_directory, "content_hashes.json")
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+
+        path = os.path.abspath(file_path)
+        signature = file_signature(file_path)
+        if path in index and index[path]["signature"] == signature:
+            return index[path]["hash"]
+
+        index[path] = {"signature": signature, "hash": hash_file_content(file_path)}
+        tmp_path = index_path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+        return index[path]["hash"]
+
+    def key(self, file_path: str, config: Dict[str, Any]) -> str:
+        sha = hashlib.sha1(self.content_hash(file_path).encode())
+        sha.update(json.dumps(config, sort_keys=True).encode())
+        sha.update(str(CACHE_FORMAT_VERSION).encode())
+        return sha.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._cache_directory, key + ".pkl")
+
+    def read(self, key: str) -> Optional[Iterator[Dict[str, Any]]]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        # Touch the file so eviction sees it as recently used.
+        os.utime(path)
+        logger.info("Reading preprocessed documents from cache %s", path)
+        return self._iter_file(path)
+
+    @staticmethod
+    def _iter_file(path: str) -> Iterator[Dict[str, Any]]:
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def write_through(self, key: str, documents: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Yield ``documents`` while writing them to the cache. The cache entry is only
+        committed if the iteration runs to completion.
+        """
+        path = self._path(key)
+        tmp_path = path + ".%d.tmp" % os.getpid()
+        completed = False
+        try:
+            with open(tmp_path, "wb") as f:
+                for document in documents:
+                    pickle.dump(document, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield document
+            completed = True
+        finally:
+            if completed:
+                os.replace(tmp_path, path)
+                logger.info("Wrote preprocessed documents to cache %s", path)
+                self.evict()
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self) -> None:
+        entries = []
+        for name in os.listdir(self._cache_directory):
+            if not name.endswith(".pkl"):
+                continue
+            path = os.path.join(self._cache_directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self._max_size_bytes:
+                break
+            logger.info("Evicting %s from document cache", path)
+            os.remove(path)
+            total_size -= size
@@ -0,0 +1,139 @@
+import uuid
+import weakref
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+Span = Tuple[int, int]
+
+
+class SpanTable:
+    """
+    Read only ``Dict[Span, List[value]]`` backed by arrays instead of tuple keyed dicts.
+    Spans are stored as int32 starts / ends sorted by (start, end) and the values in CSR
+    layout (int32 offsets into one int32 value array). If ``labels`` is given, values are
+    strings from that label set and are stored as indices into it.
+    """
+
+    def __init__(self, mapping: Dict[Span, List[Any]], labels: Sequence[str] = None) -> None:
+        spans = sorted(mapping.keys())
+        self._labels = list(labels) if labels is not None else None
+        label_to_index = {l: i for i, l in enumerate(self._labels)} if labels is not None else None
+
+        self._starts = np.array([s for s, _ in spans], dtype=np.int32)
+        self._ends = np.array([e for _, e in spans], dtype=np.int32)
+        lengths = np.array([len(mapping[span]) for span in spans], dtype=np.int32)
+        self._offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+
+        values = [v for span in spans for v in mapping[span]]
+        if label_to_index is not None:
+            values = [label_to_index[v] for v in values]
+        self._values = np.array(values, dtype=np.int32)
+
+    def _find(self, span: Span) -> int:
+        lo = np.searchsorted(self._starts, span[0], side="left")
+        hi = np.searchsorted(self._starts, span[0], side="right")
+        k = lo + np.searchsorted(self._ends[lo:hi], span[1], side="left")
+        if k < hi and self._ends[k] == span[1]:
+            return int(k)
+        return -1
+
+    def _values_at(self, k: int) -> List[Any]:
+        values = self._values[self._offsets[k] : self._offsets[k + 1]].tolist()
+        if self._labels is not None:
+            values = [self._labels[v] for v in values]
+        return values
+
+    def get(self, span: Span, default: Any = None) -> Any:
+        k = self._find(span)
+        return self._values_at(k) if k >= 0 else default
+
+    def __getitem__(self, span: Span) -> List[Any]:
+        k = self._find(span)
+        if k < 0:
+            raise KeyError(span)
+        return self._values_at(k)
+
+    def __contains__(self, span: Span) -> bool:
+        return self._find(span) >= 0
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __iter__(self) -> Iterator[Span]:
+        return iter(self.keys())
+
+    def keys(self) -> List[Span]:
+        return list(zip(self._starts.tolist(), self._ends.tolist()))
+
+    def items(self) -> Iterator[Tuple[Span, List[Any]]]:
+        for k, span in enumerate(self.keys()):
+            yield span, self._values_at(k)
+
+
+class DocumentMetadata:
+    """
+    Document level metadata shared by all paragraph instances of a document, so reader
+    memory scales with documents and not paragraphs. Supports the old dict style access
+    (``document_metadata["cluster_name_to_id"]``).
+
+    Each object carries a unique key. Unpickling returns the live object with the same key
+    if there is one, so paragraph instances pickled separately (cache, worker processes)
+    share one copy again once loaded.
+    """
+
+    _loaded: "weakref.WeakValueDictionary[str, DocumentMetadata]" = weakref.WeakValueDictionary()
+
+    def __init__(
+        self,
+        doc_id: str,
+        words: List[str],
+        cluster_name_to_id: Dict[str, int],
+        span_to_cluster_ids: Dict[Span, List[int]],
+        relation_to_cluster_ids: Dict[int, Tuple[int, ...]],
+        type_to_cluster_ids: Dict[str, List[int]],
+        entities_to_features_map: Dict[Span, List[str]],
+    ) -> None:
+        self.doc_id = doc_id
+        self.words = words
+        self.doc_length = len(words)
+        self.cluster_name_to_id = cluster_name_to_id
+        self.relation_to_cluster_ids = relation_to_cluster_ids
+        self.type_to_cluster_ids = type_to_cluster_ids
+        self.span_to_cluster_ids = (
+            span_to_cluster_ids if isinstance(span_to_cluster_ids, SpanTable) else SpanTable(span_to_cluster_ids)
+        )
+        self.entities_to_features_map = (
+            entities_to_features_map
+            if isinstance(entities_to_features_map, SpanTable)
+            else SpanTable(
+                entities_to_features_map,
+                labels=sorted(set(f for v in entities_to_features_map.values() for f in v)),
+            )
+        )
+
+        self._key = uuid.uuid4().hex
+        DocumentMetadata._loaded[self._key] = self
+
+    def __getitem__(self, key: str) -> Any:
+        if key.startswith("_") or key not in self.__dict__:
+            raise KeyError(key)
+        return self.__dict__[key]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __reduce__(self):
+        return (_load_document_metadata, (self._key, self.__dict__))
+
+
+def _load_document_metadata(key: str, state: Dict[str, Any]) -> DocumentMetadata:
+    document_metadata = DocumentMetadata._loaded.get(key)
+    if document_metadata is None:
+        document_metadata = DocumentMetadata.__new__(DocumentMetadata)
+        document_metadata.__dict__.update(state)
+        DocumentMetadata._loaded[key] = document_metadata
+    return document_metadata
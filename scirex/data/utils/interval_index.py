@@ -0,0 +1,43 @@
+from bisect import bisect_left, bisect_right
+from typing import List, Optional, Sequence, Tuple
+
+from scirex.data.utils.span_utils import does_overlap
+
+Span = Tuple[int, int]
+
+
+class IntervalIndex:
+    """
+    Sorted boundary index over a list of non overlapping spans (sentences, sections, paragraphs).
+    Build it once per document and resolve containment / overlap of entities in O(log n)
+    instead of testing each span against every interval with ``is_x_in_y``.
+
+    Returned indices always refer to positions in the list the index was built from.
+    Empty intervals are allowed (they never contain or overlap a non empty span).
+    """
+
+    def __init__(self, intervals: Sequence[Span]):
+        self._order = sorted(range(len(intervals)), key=lambda i: (intervals[i][0], intervals[i][1]))
+        self._starts = [intervals[i][0] for i in self._order]
+        self._ends = [intervals[i][1] for i in self._order]
+
+        # Each span can lie in atmost one interval only if intervals don't overlap.
+        assert all(self._ends[k] <= self._starts[k + 1] for k in range(len(self._order) - 1)), breakpoint()
+
+    def __len__(self):
+        return len(self._order)
+
+    def containing(self, span: Span) -> Optional[int]:
+        """Index of the interval y such that is_x_in_y(span, y), or None."""
+        k = bisect_right(self._starts, span[0]) - 1
+        if k >= 0 and span[1] <= self._ends[k]:
+            return self._order[k]
+        return None
+
+    def overlapping(self, span: Span) -> List[int]:
+        """Sorted indices of all intervals y such that does_overlap(span, y)."""
+        lo = bisect_right(self._ends, span[0])
+        hi = bisect_left(self._starts, span[1])
+        return sorted(
+            self._order[k] for k in range(lo, hi) if does_overlap(span, (self._starts[k], self._ends[k]))
+        )
@@ -0,0 +1,159 @@
+"""
+Lexical cascade for pairwise coreference: decide the easy mention pairs from their strings
+and leave only the ambiguous middle band to the model.
+
+Thresholds can be tuned on dev data with
+
+    python -m scirex.data.utils.lexical_cascade --dev_file dev.jsonl --max_error 0.01
+"""
+import argparse
+import logging
+from typing import Dict, List, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from scirex_utilities.entity_matching_algorithms import clean_text, get_n_grams, match_abbr
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+ACCEPT, REJECT, MODEL = "accept", "reject", "model"
+
+
+def batch_char_sim(pairs: List[Tuple[str, str]], ng: int = 3) -> np.ndarray:
+    """
+    ``char_sim(w1, w2, ng)`` (without abbreviation n-grams) for every pair. The n-gram jaccard
+    part is computed with sparse products over the unique strings instead of per pair sets.
+    """
+    cleaned: Dict[str, List[str]] = {}
+    for w1, w2 in pairs:
+        for w in (w1, w2):
+            if w not in cleaned:
+                cleaned[w] = clean_text(w)
+
+    scores = np.zeros(len(pairs))
+    # char_sim shrinks n to the longest word of the shorter-worded side, group pairs by it.
+    pair_ng = np.array(
+        [
+            min(max(len(x) for x in cleaned[w1]), max(len(x) for x in cleaned[w2]), ng)
+            if len(cleaned[w1]) > 0 and len(cleaned[w2]) > 0
+            else 0
+            for w1, w2 in pairs
+        ],
+        dtype=np.int64,
+    )
+
+    for n in set(pair_ng.tolist()) - {0}:
+        index = np.nonzero(pair_ng == n)[0]
+        strings = sorted(set(w for i in index for w in pairs[i]))
+        string_to_row = {w: r for r, w in enumerate(strings)}
+
+        n_gram_to_column: Dict[str, int] = {}
+        rows, columns = [], []
+        for r, w in enumerate(strings):
+            for g in set(get_n_grams(cleaned[w], n)):
+                rows.append(r)
+                columns.append(n_gram_to_column.setdefault(g, len(n_gram_to_column)))
+        incidence = csr_matrix(
+            (np.ones(len(rows)), (rows, columns)), shape=(len(strings), max(len(n_gram_to_column), 1))
+        )
+
+        rows_1 = [string_to_row[pairs[i][0]] for i in index]
+        rows_2 = [string_to_row[pairs[i][1]] for i in index]
+        sizes = np.asarray(incidence.sum(axis=1)).ravel()
+        intersection = np.asarray(incidence[rows_1].multiply(incidence[rows_2]).sum(axis=1)).ravel()
+        scores[index] = intersection / (sizes[rows_1] + sizes[rows_2] - intersection)
+
+    abbr_scores: Dict[Tuple[str, str], float] = {}
+    for i, (w1, w2) in enumerate(pairs):
+        if pair_ng[i] == 0:
+            continue
+        key = (" ".join(cleaned[w1]), " ".join(cleaned[w2]))
+        if key not in abbr_scores:
+            abbr_scores[key] = match_abbr(*key)
+        scores[i] = max(scores[i], abbr_scores[key])
+
+    return scores
+
+
+class LexicalCascade:
+    """
+    Routes mention pairs to ``accept`` (identical lowercased strings, or char_sim at least
+    ``accept_threshold``), ``reject`` (char_sim at most ``reject_threshold``) or ``model``.
+    Decided pairs get ``accept_score`` / ``reject_score`` in place of a model score.
+    """
+
+    def __init__(
+        self,
+        accept_threshold: float = float("inf"),
+        reject_threshold: float = 0.0,
+        accept_score: float = 1.0,
+        reject_score: float = 0.0,
+    ) -> None:
+        self._accept_threshold = accept_threshold
+        self._reject_threshold = reject_threshold
+        self.route_scores = {ACCEPT: accept_score, REJECT: reject_score}
+
+    def route(self, pairs: List[Tuple[str, str]]) -> List[str]:
+        scores = batch_char_sim(pairs)
+        routes = []
+        for (w1, w2), score in zip(pairs, scores):
+            if w1.lower() == w2.lower() or score >= self._accept_threshold:
+                routes.append(ACCEPT)
+            elif score <= self._reject_threshold:
+                routes.append(REJECT)
+            else:
+                routes.append(MODEL)
+
+        logger.debug(
+            "Lexical cascade routes - accept : %d, reject : %d, model : %d",
+            routes.count(ACCEPT),
+            routes.count(REJECT),
+            routes.count(MODEL),
+        )
+        return routes
+
+
+def tune_thresholds(scores: np.ndarray, labels: np.ndarray, max_error: float = 0.01) -> Tuple[float, float]:
+    """
+    Largest reject threshold such that at most ``max_error`` of the rejected pairs are
+    coreferent, and smallest accept threshold such that at most ``max_error`` of the accepted
+    pairs are not.
+    """
+    reject_threshold, accept_threshold = -float("inf"), float("inf")
+
+    order = np.argsort(scores, kind="stable")
+    sorted_scores, sorted_labels = scores[order], labels[order]
+    n_rejected = np.arange(1, len(order) + 1)
+    reject_error = np.cumsum(sorted_labels == 1) / n_rejected
+    # Thresholds only make sense where the score changes, ties go together.
+    last_of_value = np.append(sorted_scores[1:] != sorted_scores[:-1], True)
+    ok = np.nonzero((reject_error <= max_error) & last_of_value)[0]
+    if len(ok) > 0:
+        reject_threshold = float(sorted_scores[ok[-1]])
+
+    sorted_scores, sorted_labels = sorted_scores[::-1], sorted_labels[::-1]
+    accept_error = np.cumsum(sorted_labels == 0) / n_rejected
+    last_of_value = np.append(sorted_scores[1:] != sorted_scores[:-1], True)
+    ok = np.nonzero((accept_error <= max_error) & last_of_value)[0]
+    if len(ok) > 0:
+        accept_threshold = float(sorted_scores[ok[-1]])
+
+    return reject_threshold, accept_threshold
+
+
+if __name__ == "__main__":
+    from scirex.data.dataset_readers.coreference_train_reader import ScirexCoreferenceTrainReader
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dev_file", type=str, required=True)
+    parser.add_argument("--max_error", type=float, default=0.01)
+    args = parser.parse_args()
+
+    # Train reader pairs are (type + " " + w1, type + " " + w2, gold label).
+    dev_pairs = ScirexCoreferenceTrainReader.generate_pairs(args.dev_file)
+    dev_scores = batch_char_sim([(p.split(" ", 1)[1], h.split(" ", 1)[1]) for p, h, _ in dev_pairs])
+    dev_labels = np.array([label for _, _, label in dev_pairs])
+
+    reject_threshold, accept_threshold = tune_thresholds(dev_scores, dev_labels, args.max_error)
+    print("reject_threshold : %f, accept_threshold : %f" % (reject_threshold, accept_threshold))
@@ -0,0 +1,74 @@
+import logging
+import zlib
+from itertools import combinations
+from typing import Dict, Hashable, List, Set, Tuple
+
+import numpy as np
+
+from scirex_utilities.entity_matching_algorithms import clean_text, get_n_grams
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+_PRIME = (1 << 31) - 1
+
+
+class MentionBlocker:
+    """
+    Candidate blocking for mention pairs. Instead of all ``combinations(mentions, 2)``, only
+    pairs of mentions sharing a block are kept. Blocks are
+
+        - the lowercased surface string (any type, these pairs are always scored),
+        - (type, acronym signature): initials of a multi word mention, the word itself otherwise,
+          so "CNN" meets "convolutional neural network",
+        - (type, band) of a MinHash LSH signature over character n-grams (same n-grams as
+          ``char_sim`` in entity_matching_algorithms).
+
+    Two mentions with n-gram Jaccard similarity ``s`` share an LSH band with probability
+    ``1 - (1 - s ** rows) ** bands``. More bands / fewer rows trades throughput for recall.
+    """
+
+    def __init__(self, bands: int = 16, rows: int = 2, ngram: int = 3, seed: int = 0) -> None:
+        self._bands = bands
+        self._rows = rows
+        self._ngram = ngram
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _PRIME, size=bands * rows).astype(np.uint64)
+        self._b = rng.randint(0, _PRIME, size=bands * rows).astype(np.uint64)
+
+    def _minhash(self, n_grams: List[str]) -> np.ndarray:
+        hashes = np.array([zlib.crc32(g.encode("utf-8")) % _PRIME for g in set(n_grams)], dtype=np.uint64)
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def blocks(self, text: str, entity_type: str) -> List[Hashable]:
+        keys: List[Hashable] = [("surface", text.lower())]
+        words = clean_text(text)
+        if len(words) == 0:
+            return keys
+
+        acronym = "".join(w[0] for w in words) if len(words) > 1 else words[0]
+        keys.append(("acronym", entity_type, acronym))
+
+        signature = self._minhash(get_n_grams(words, self._ngram)).tolist()
+        for band in range(self._bands):
+            keys.append(("lsh", entity_type, band) + tuple(signature[band * self._rows : (band + 1) * self._rows]))
+        return keys
+
+    def candidate_pairs(self, mentions: List[Tuple[str, str]]) -> List[Tuple[int, int]]:
+        """
+        Sorted (i, j), i < j index pairs of ``mentions`` ((text, type) tuples) sharing a block.
+        """
+        signatures: Dict[Tuple[str, str], List[Hashable]] = {}
+        members: Dict[Hashable, List[int]] = {}
+        for i, mention in enumerate(mentions):
+            if mention not in signatures:
+                signatures[mention] = self.blocks(*mention)
+            for key in signatures[mention]:
+                members.setdefault(key, []).append(i)
+
+        pairs: Set[Tuple[int, int]] = set()
+        for block in members.values():
+            pairs.update(combinations(block, 2))
+
+        n_all = len(mentions) * (len(mentions) - 1) // 2
+        logger.debug("Blocking kept %d of %d mention pairs", len(pairs), n_all)
+        return sorted(pairs)
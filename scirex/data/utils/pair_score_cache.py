@@ -0,0 +1,86 @@
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+PairKey = Tuple[str, str]  # (premise, hypothesis), normalized.
+
+
+class PairScoreCache:
+    """
+    On disk (sqlite) cache of pairwise coreference scores, shared across documents and runs.
+
+    Keys are normalized (premise, hypothesis) strings plus a fingerprint of the model that
+    scored them, so scores of one archive are never served for another. Every hit refreshes
+    the entry's last use time and least recently used entries are evicted once the database
+    grows past ``max_size_mb``.
+    """
+
+    def __init__(self, cache_directory: str, model_fingerprint: str, max_size_mb: int = 1024) -> None:
+        os.makedirs(cache_directory, exist_ok=True)
+        self._path = os.path.join(cache_directory, "pair_scores.sqlite")
+        self._model = model_fingerprint
+        self._max_size_bytes = max_size_mb * 1024 * 1024
+
+        self._db = sqlite3.connect(self._path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "model TEXT, premise TEXT, hypothesis TEXT, score REAL, last_used REAL, "
+            "PRIMARY KEY (model, premise, hypothesis))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+        self._db.commit()
+
+    def get_many(self, keys: Iterable[PairKey]) -> Dict[PairKey, float]:
+        found = {}
+        for premise, hypothesis in set(keys):
+            row = self._db.execute(
+                "SELECT score FROM scores WHERE model = ? AND premise = ? AND hypothesis = ?",
+                (self._model, premise, hypothesis),
+            ).fetchone()
+            if row is not None:
+                found[(premise, hypothesis)] = row[0]
+
+        now = time.time()
+        self._db.executemany(
+            "UPDATE scores SET last_used = ? WHERE model = ? AND premise = ? AND hypothesis = ?",
+            [(now, self._model, premise, hypothesis) for premise, hypothesis in found],
+        )
+        self._db.commit()
+        return found
+
+    def put_many(self, scores: List[Tuple[PairKey, float]]) -> None:
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)",
+            [(self._model, premise, hypothesis, score, now) for (premise, hypothesis), score in scores],
+        )
+        self._db.commit()
+        self.evict()
+
+    def _size(self) -> int:
+        page_count = self._db.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self._db.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self._db.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def evict(self) -> None:
+        size = self._size()
+        if size <= self._max_size_bytes:
+            return
+
+        # Drop the least recently used entries in proportion to the overshoot, plus some
+        # slack so we don't evict again on the next insert. Freed pages are reused.
+        n_entries = self._db.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+        n_evict = int(n_entries * (1 - 0.9 * self._max_size_bytes / size)) + 1
+        logger.info("Evicting %d entries from pair score cache %s", n_evict, self._path)
+        self._db.execute(
+            "DELETE FROM scores WHERE rowid IN (SELECT rowid FROM scores ORDER BY last_used LIMIT ?)", (n_evict,)
+        )
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
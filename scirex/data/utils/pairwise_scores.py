@@ -0,0 +1,81 @@
+"""
+Binary container for pairwise coreference scores, the compact alternative to the
+``pairwise_coreference_scores`` jsonl written by ``predict_pairwise_coreference.py``.
+
+The file is a zip archive readable with ``np.load`` (hence the ``.npz`` extension). Document ``k``
+(in write order) is stored as three members:
+
+    k/spans.npy     int32 (n, 2), sorted unique mention spans of the document
+    k/pairs.npy     int32 (m, 2), (i, j) indices into spans of each scored pair
+    k/scores.npy    float16 (m,), score of each pair
+
+and ``doc_ids.json`` lists the doc_id of each document. Documents are written as soon as
+they are added, so the writer never holds more than one document.
+"""
+import json
+import zipfile
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+Span = Tuple[int, int]
+
+
+def is_pairwise_scores_file(file_path: str) -> bool:
+    return file_path.endswith(".npz")
+
+
+def pairwise_scores_to_arrays(pairwise_scores: List[Tuple[Span, Span, float]]):
+    """((s1, e1), (s2, e2), score) triples -> spans, (i, j) pair indices and scores arrays."""
+    spans = sorted(set([tuple(p) for p, _, _ in pairwise_scores] + [tuple(h) for _, h, _ in pairwise_scores]))
+    span_to_index = {span: i for i, span in enumerate(spans)}
+
+    pairs = np.array(
+        [(span_to_index[tuple(p)], span_to_index[tuple(h)]) for p, h, _ in pairwise_scores], dtype=np.int32
+    ).reshape(-1, 2)
+    scores = np.array([score for _, _, score in pairwise_scores], dtype=np.float16)
+    return np.array(spans, dtype=np.int32).reshape(-1, 2), pairs, scores
+
+
+class PairwiseScoresWriter:
+    def __init__(self, file_path: str) -> None:
+        self._zip = zipfile.ZipFile(file_path, "w", compression=zipfile.ZIP_STORED)
+        self._doc_ids: List[str] = []
+
+    def _write_array(self, name: str, array: np.ndarray) -> None:
+        with self._zip.open(name + ".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    def add_document(self, doc_id: str, pairwise_scores: List[Tuple[Span, Span, float]]) -> None:
+        spans, pairs, scores = pairwise_scores_to_arrays(pairwise_scores)
+        k = len(self._doc_ids)
+        self._write_array("%d/spans" % k, spans)
+        self._write_array("%d/pairs" % k, pairs)
+        self._write_array("%d/scores" % k, scores)
+        self._doc_ids.append(doc_id)
+
+    def close(self) -> None:
+        self._zip.writestr("doc_ids.json", json.dumps(self._doc_ids))
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_pairwise_scores(file_path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Yield ``{"doc_id", "spans", "pairs", "scores"}`` per document, with the arrays described
+    in the module docstring. Each document is loaded only when it is reached.
+    """
+    with np.load(file_path, allow_pickle=False) as data:
+        doc_ids = json.loads(data.zip.read("doc_ids.json"))
+        for k, doc_id in enumerate(doc_ids):
+            yield {
+                "doc_id": doc_id,
+                "spans": data["%d/spans" % k],
+                "pairs": data["%d/pairs" % k],
+                "scores": data["%d/scores" % k],
+            }
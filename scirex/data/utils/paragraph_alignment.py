@@ -2,7 +2,7 @@ from typing import List, Tuple
 
 import numpy as np
 
-from scirex.data.utils.span_utils import is_x_in_y
+from scirex.data.utils.interval_index import IntervalIndex
 
 Span = Tuple[int, int]
 
@@ -73,25 +73,20 @@ def move_boundaries(plist, elist):
     for p, q in zip(new_paragraphs[:-1], new_paragraphs[1:]):
         assert p[1] == q[0]
 
+    paragraph_index = IntervalIndex(new_paragraphs)
     for e in elist:
-        done = False
-        for p in new_paragraphs:
-            if is_x_in_y((e[0], e[1]), p):
-                done = True
-        assert done
+        assert paragraph_index.containing((e[0], e[1])) is not None
 
     return new_paragraphs
 
 
 def group_sentences_to_sections(sentences: List[Span], sections: List[Span]) -> List[List[Span]]:
     grouped_sentences = [[] for _ in range(len(sections))]
+    section_index = IntervalIndex(sections)
     for s in sentences:
-        done = 0
-        for i, sec in enumerate(sections):
-            if is_x_in_y(s, sec):
-                grouped_sentences[i].append(s)
-                done += 1
-        if done != 1:
+        i = section_index.containing(s)
+        if i is None:
             breakpoint()
+        grouped_sentences[i].append(s)
 
     return grouped_sentences
@@ -1,5 +1,5 @@
 from typing import List, Tuple
-from scirex.data.utils.span_utils import is_x_in_y
+from scirex.data.utils.interval_index import IntervalIndex
 
 experiment_words_to_check = set("experiment|evaluation|evaluate|evaluate".split("|"))
 dataset_words_to_check = set("dataset|corpus|corpora".split("|"))
@@ -32,17 +32,13 @@ def get_features_for_sections(sections: List[Tuple[int, int]], words_list: List[
 def extract_sentence_features(sentences, words, entities):
     entities_to_features_map = {}
     sentence_features = [get_features_for_sections(sents, words) for sents in sentences]
+    flat_features = [f for features in sentence_features for f in features]
+    sentence_index = IntervalIndex([sspan for sents in sentences for sspan in sents])
     for e in entities:
-        index = [
-            (i, j)
-            for i, sents in enumerate(sentences)
-            for j, sspan in enumerate(sents)
-            if is_x_in_y(e, sspan)
-        ]
-        assert len(index) == 1, breakpoint()
-
-        i, j = index[0]
-        entities_to_features_map[(e[0], e[1])] = sentence_features[i][j]
+        k = sentence_index.containing(e)
+        assert k is not None, breakpoint()
+
+        entities_to_features_map[(e[0], e[1])] = flat_features[k]
 
     return entities_to_features_map
 
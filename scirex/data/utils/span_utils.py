@@ -1,24 +1,28 @@
 from allennlp.data.dataset_readers.dataset_utils.span_utils import to_bioul
 
 def spans_to_bio_tags(spans, length) :
-    tag_sequence = ['O'] * length
-    for span in spans :
-        is_inner_span = False
-        for span_2 in spans :
-            if (not is_same_span(span, span_2)) and is_x_in_y(span, span_2) :
-                is_inner_span = True
+    # A span is dropped if some other span (different boundaries) contains it.
+    # Sort distinct boundaries by (start asc, end desc) and sweep: every span that can
+    # contain the current one comes before it, so keeping the max end seen so far is enough.
+    inner_spans = set()
+    max_end = None
+    for start, end in sorted(set((s, e) for s, e, _ in spans), key=lambda x: (x[0], -x[1])) :
+        if max_end is not None and end <= max_end :
+            inner_spans.add((start, end))
+        else :
+            max_end = end
 
-        if is_inner_span :
+    tag_sequence = ['O'] * length
+    for start, end, label in spans :
+        if (start, end) in inner_spans :
             continue
 
-        start, end, label = span
         tag_sequence[start] = 'B-' + label
-        for ix in range(start + 1, end) :
-            tag_sequence[ix] = 'I-' + label
+        tag_sequence[start + 1:end] = ['I-' + label] * (end - start - 1)
 
     return to_bioul(tag_sequence, encoding='BIO')
 
 is_same_span = lambda x, y : x[0] == y[0] and x[1] == y[1]
 is_x_in_y = lambda x, y: x[0] >= y[0] and x[1] <= y[1]
 
-does_overlap = lambda x, y: max(x[0], y[0]) < min(x[1], y[1])
\ No newline at end of file
+does_overlap = lambda x, y: max(x[0], y[0]) < min(x[1], y[1])
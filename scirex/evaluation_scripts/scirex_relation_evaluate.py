@@ -4,10 +4,11 @@ from typing import Dict
 
 import pandas as pd
 
+from scirex.data.utils.columnar_corpus import read_documents
 from scirex.metrics.clustering_metrics import match_predicted_clusters_to_gold
 from scirex.predictors.utils import map_predicted_spans_to_gold, merge_method_subrelations
 from scirex_utilities.entity_utils import used_entities
-from scirex_utilities.json_utilities import load_jsonl
+from scirex_utilities.json_utilities import LazyJsonlDict
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--gold-file")
@@ -20,40 +21,6 @@ def has_all_mentions(doc, relation):
     return has_mentions
 
 
-def convert_to_dict(data):
-    return {x["doc_id"]: x for x in data}
-
-
-def ner_metrics(gold_data, predicted_data):
-    mapping = {}
-    for doc in gold_data:
-        predicted_doc = predicted_data[doc["doc_id"]]
-        predicted_spans = predicted_doc["ner"]
-        gold_spans = doc["ner"]
-
-        mapping[doc["doc_id"]] = map_predicted_spans_to_gold(predicted_spans, gold_spans)
-
-    return mapping
-
-
-def clustering_metrics(gold_data, predicted_clusters, span_map):
-    all_metrics = []
-    mappings = {}
-    for doc in gold_data:
-        predicted_doc = predicted_clusters[doc["doc_id"]]
-        metrics, mapping = match_predicted_clusters_to_gold(
-            predicted_doc["clusters"], doc["coref"], span_map[doc["doc_id"]], doc['words']
-        )
-        mappings[doc["doc_id"]] = mapping
-        all_metrics.append(metrics)
-
-    all_metrics = pd.DataFrame(all_metrics)
-    print("Salient Clustering Metrics")
-    print(all_metrics.describe().loc['mean'])
-
-    return mappings
-
-
 def get_types_of_clusters(predicted_ner, predicted_clusters):
     for doc_id in predicted_clusters:
         clusters = predicted_clusters[doc_id]["clusters"]
@@ -68,58 +35,70 @@ def get_types_of_clusters(predicted_ner, predicted_clusters):
             predicted_clusters[doc_id]["types"][c] = list(types)[0]
 
 
-def main(args):
-    gold_data = load_jsonl(args.gold_file)
-    for d in gold_data:
-        merge_method_subrelations(d)
-        d["clusters"] = d["coref"]
-
-    predicted_ner = convert_to_dict(load_jsonl(args.ner_file))
-    predicted_salient_clusters = convert_to_dict(load_jsonl(args.clusters_file))
-    for d, doc in predicted_salient_clusters.items() :
-        if 'clusters' not in doc :
-            merge_method_subrelations(doc)
-            doc['clusters'] = {x:v for x, v in doc['coref'].items() if len(v) > 0}
-
-    predicted_relations = convert_to_dict(load_jsonl(args.relations_file))
+def relation_metrics(doc, predicted_data, mapping, types):
+    relations = list(set([
+        tuple([mapping.get(v, v) for v in x[0]])
+        for x in predicted_data["predicted_relations"]
+        if x[2] == 1
+    ]))
 
-    predicted_span_to_gold_span_map: Dict[str, Dict[tuple, tuple]] = ner_metrics(gold_data, predicted_ner)
-    get_types_of_clusters(predicted_ner, predicted_salient_clusters)
-    get_types_of_clusters(convert_to_dict(gold_data), convert_to_dict(gold_data))
-    predicted_cluster_to_gold_cluster_map = clustering_metrics(
-        gold_data, predicted_salient_clusters, predicted_span_to_gold_span_map
-    )
+    relations = [dict(zip(used_entities, x)) for x in relations]
+    relations = set([tuple((t, x[t]) for t in types) for x in relations])
 
-    for n in [2, 4] :
-        all_metrics = []
-        for types in combinations(used_entities, n):
-            for doc in gold_data:
-                predicted_data = predicted_relations[doc["doc_id"]]
-                mapping = predicted_cluster_to_gold_cluster_map[doc["doc_id"]]
+    gold_relations = [tuple((t, x[t]) for t in types) for x in doc['n_ary_relations']]
+    gold_relations = set([x for x in gold_relations if has_all_mentions(doc, x)])
 
-                relations = list(set([
-                    tuple([mapping.get(v, v) for v in x[0]])
-                    for x in predicted_data["predicted_relations"]
-                    if x[2] == 1
-                ]))
+    matched = relations & gold_relations
 
-                relations = [dict(zip(used_entities, x)) for x in relations]
-                relations = set([tuple((t, x[t]) for t in types) for x in relations])
+    metrics = {
+        "p": len(matched) / (len(relations) + 1e-7),
+        "r": len(matched) / (len(gold_relations) + 1e-7),
+    }
+    metrics["f1"] = 2 * metrics["p"] * metrics["r"] / (metrics["p"] + metrics["r"] + 1e-7)
 
-                gold_relations = [tuple((t, x[t]) for t in types) for x in doc['n_ary_relations']]
-                gold_relations = set([x for x in gold_relations if has_all_mentions(doc, x)])
+    return metrics, len(gold_relations)
 
-                matched = relations & gold_relations
 
-                metrics = {
-                    "p": len(matched) / (len(relations) + 1e-7),
-                    "r": len(matched) / (len(gold_relations) + 1e-7),
-                }
-                metrics["f1"] = 2 * metrics["p"] * metrics["r"] / (metrics["p"] + metrics["r"] + 1e-7)
-
-                if len(gold_relations) > 0:
-                    all_metrics.append(metrics)
+def main(args):
+    with LazyJsonlDict(args.ner_file) as predicted_ner, LazyJsonlDict(
+        args.clusters_file
+    ) as predicted_salient_clusters, LazyJsonlDict(args.relations_file) as predicted_relations:
+        # Gold documents are streamed and joined one at a time with the prediction files through
+        # their byte offset indices, so memory doesn't grow with the number of documents.
+        all_clustering_metrics = []
+        all_relation_metrics = {2: [], 4: []}
+        for doc in read_documents(args.gold_file):
+            doc_id = doc["doc_id"]
+            merge_method_subrelations(doc)
+            doc["clusters"] = doc["coref"]
+
+            ner_doc = predicted_ner[doc_id]
+            clusters_doc = predicted_salient_clusters[doc_id]
+            if 'clusters' not in clusters_doc :
+                merge_method_subrelations(clusters_doc)
+                clusters_doc['clusters'] = {x:v for x, v in clusters_doc['coref'].items() if len(v) > 0}
+
+            span_map: Dict[tuple, tuple] = map_predicted_spans_to_gold(ner_doc["ner"], doc["ner"])
+            get_types_of_clusters({doc_id: ner_doc}, {doc_id: clusters_doc})
+            get_types_of_clusters({doc_id: doc}, {doc_id: doc})
+
+            metrics, mapping = match_predicted_clusters_to_gold(
+                clusters_doc["clusters"], doc["coref"], span_map, doc['words']
+            )
+            all_clustering_metrics.append(metrics)
+
+            predicted_data = predicted_relations[doc_id]
+            for n, metrics_n in all_relation_metrics.items():
+                for types in combinations(used_entities, n):
+                    metrics, n_gold_relations = relation_metrics(doc, predicted_data, mapping, types)
+                    if n_gold_relations > 0:
+                        metrics_n.append(metrics)
+
+    all_clustering_metrics = pd.DataFrame(all_clustering_metrics)
+    print("Salient Clustering Metrics")
+    print(all_clustering_metrics.describe().loc['mean'])
 
+    for n, all_metrics in all_relation_metrics.items():
         all_metrics = pd.DataFrame(all_metrics)
         print(f"Relation Metrics n={n}")
         print(all_metrics.describe().loc['mean'][['p', 'r', 'f1']])
@@ -1,12 +1,27 @@
+from heapq import heappop, heappush, heappushpop
+
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.cluster.hierarchy import linkage
+from scipy.sparse import coo_matrix, csr_matrix, issparse
 from scipy.sparse.csgraph import connected_components
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.metrics import silhouette_score
+
+# Documents with more spans than this are clustered from a sparse score matrix.
+SPARSE_CLUSTERING_MIN_SPANS = 2000
 
 
-def generate_matrix_for_document(document, span_field, matrix_field) :
+def generate_matrix_for_document(document, span_field, matrix_field, sparse=None) :
     span2idx = {tuple(k):i for i, k in enumerate(document[span_field])}
+    if sparse is None :
+        sparse = len(span2idx) > SPARSE_CLUSTERING_MIN_SPANS
+
+    if sparse :
+        pairs = np.array(
+            [(span2idx[tuple(e1)], span2idx[tuple(e2)]) for e1, e2, _ in document[matrix_field]], dtype=np.intp
+        ).reshape(-1, 2)
+        scores = np.array([score for _, _, score in document[matrix_field]], dtype=np.float64)
+        return generate_matrix_from_pairs(len(span2idx), pairs, scores, sparse=True)
+
     matrix = np.zeros((len(span2idx), len(span2idx)))
     for e1, e2, score in document[matrix_field] :
         matrix[span2idx[tuple(e1)], span2idx[tuple(e2)]] = score
@@ -14,24 +29,236 @@ def generate_matrix_for_document(document, span_field, matrix_field) :
     return matrix
 
 
+def generate_matrix_from_pairs(n_spans, pairs, scores, sparse=None) :
+    # pairs / scores as stored by scirex.data.utils.pairwise_scores, no span lookups needed.
+    if sparse is None :
+        sparse = n_spans > SPARSE_CLUSTERING_MIN_SPANS
+
+    if sparse :
+        return csr_matrix((scores, (pairs[:, 0], pairs[:, 1])), shape=(n_spans, n_spans))
+
+    matrix = np.zeros((n_spans, n_spans))
+    matrix[pairs[:, 0], pairs[:, 1]] = scores
+    return matrix
+
+
+def complete_linkage_children(distances) :
+    # Same tree as AgglomerativeClustering(linkage='complete', affinity='precomputed').children_
+    i, j = np.triu_indices(distances.shape[0], k=1)
+    return linkage(distances[i, j], method='complete')[:, :2].astype(int)
+
+
+def cut_tree(children, n_leaves, n_clusters) :
+    # Labels of AgglomerativeClustering for n_clusters (sklearn's _hc_cut), numbering included.
+    nodes = [-(max(children[-1]) + 1)]
+    for _ in range(n_clusters - 1) :
+        these_children = children[-nodes[0] - n_leaves]
+        heappush(nodes, -these_children[0])
+        heappushpop(nodes, -these_children[1])
+
+    labels = np.zeros(n_leaves, dtype=np.intp)
+    for label, node in enumerate(nodes) :
+        stack = [-node]
+        while len(stack) > 0 :
+            node = stack.pop()
+            if node < n_leaves :
+                labels[node] = label
+            else :
+                stack.extend(children[node - n_leaves])
+    return labels
+
+
+def silhouette_scores_for_tree(distances, children) :
+    '''
+    silhouette_score(distances, labels, metric='precomputed') of the cut with n clusters, for
+    every n in 2 .. N - 1 (index n - 2). Merges are replayed in order while keeping, for every
+    point, the sum of its distances to each cluster, so each cut costs O(N * n).
+    '''
+    n_leaves = distances.shape[0]
+    # Column c of cluster_sums / slot c of sizes holds the cluster rooted at node_slot[node].
+    cluster_sums = distances.astype(np.float64).copy()
+    sizes = np.ones(n_leaves)
+    active = np.ones(n_leaves, dtype=bool)
+    point_slot = np.arange(n_leaves)
+    node_slot = list(range(n_leaves))
+    members = [[i] for i in range(n_leaves)]
+    points = np.arange(n_leaves)
+
+    scores = np.zeros(max(n_leaves - 2, 0))
+    for t, (c1, c2) in enumerate(children[: n_leaves - 2]) :
+        s1, s2 = node_slot[c1], node_slot[c2]
+        cluster_sums[:, s1] += cluster_sums[:, s2]
+        sizes[s1] += sizes[s2]
+        active[s2] = False
+        point_slot[members[s2]] = s1
+        members[s1] += members[s2]
+        members[s2] = []
+        node_slot.append(s1)
+
+        own_sizes = sizes[point_slot]
+        with np.errstate(divide="ignore", invalid="ignore") :
+            intra = cluster_sums[points, point_slot] / (own_sizes - 1)
+            means = cluster_sums / sizes
+        means[:, ~active] = np.inf
+        means[points, point_slot] = np.inf
+        inter = means.min(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore") :
+            samples = (inter - intra) / np.maximum(intra, inter)
+        samples[own_sizes == 1] = 0
+        # n = N - t - 1 clusters after merge t.
+        scores[n_leaves - t - 3] = np.mean(np.nan_to_num(samples))
+
+    return scores
+
+
 def cluster_with_clustering(matrix, threshold, plot=True) :
-    scores = []
+    '''
+    Complete linkage clustering of 1 - matrix, cut at the number of clusters (2 .. N - 1) with
+    the best silhouette score. The dendrogram is built once and silhouettes of all cuts are
+    computed from it, giving the same clusters as fitting AgglomerativeClustering for every n.
+    '''
     matrix = (matrix + matrix.T) + np.eye(*matrix.shape)
-    for n in range(2, matrix.shape[0] if matrix.shape[0] > 2 else 3) :
-        clustering = AgglomerativeClustering(n_clusters=n, linkage='complete', affinity='precomputed').fit(1 - matrix)
-        if matrix.shape[0] > 2 :
-            scores.append(silhouette_score(1 - matrix, clustering.labels_, metric='precomputed'))
-        else :
-            scores.append(1)
-    try :
-        if False :
-            plt.plot(range(2, matrix.shape[0]), scores)
-        best_score = max(scores)
-    except :
-        breakpoint()
-    best_n = scores.index(best_score) + 2
-    clustering = AgglomerativeClustering(n_clusters=best_n, linkage='complete', affinity='precomputed').fit(1 - matrix)
-    return clustering.n_clusters_, clustering.labels_
+    n_leaves = matrix.shape[0]
+    if n_leaves < 2 :
+        return n_leaves, np.zeros(n_leaves, dtype=np.intp)
+
+    children = complete_linkage_children(1 - matrix)
+    if n_leaves == 2 :
+        return 2, cut_tree(children, n_leaves, 2)
+
+    scores = silhouette_scores_for_tree(1 - matrix, children)
+    if False :
+        plt.plot(range(2, n_leaves), scores)
+    # Summation order differs from silhouette_score, treat near equal scores as ties (smallest n wins).
+    best_n = int(np.argmax(np.round(scores, 10))) + 2
+    return best_n, cut_tree(children, n_leaves, best_n)
+
+def collapse_identical_mentions(matrix, span_keys, aggregation='max') :
+    '''
+    Merge the rows / columns of matrix whose span_keys are equal into super-nodes. The score
+    between two super-nodes is the max (or mean) over the scores of their member pairs, kept
+    in the upper triangle like the input. Returns the reduced matrix and the super-node of
+    each row of matrix.
+    '''
+    key_to_node = {}
+    node_of = np.array([key_to_node.setdefault(k, len(key_to_node)) for k in span_keys], dtype=np.intp)
+    if issparse(matrix) :
+        return collapse_identical_mentions_sparse(matrix, node_of, len(key_to_node), aggregation), node_of
+
+    scores = matrix + matrix.T
+
+    order = np.argsort(node_of, kind='stable')
+    starts = np.searchsorted(node_of[order], np.arange(len(key_to_node)))
+    scores = scores[order][:, order]
+    if aggregation == 'max' :
+        reduced = np.maximum.reduceat(np.maximum.reduceat(scores, starts, axis=1), starts, axis=0)
+    elif aggregation == 'mean' :
+        sizes = np.bincount(node_of, minlength=len(key_to_node))
+        reduced = np.add.reduceat(np.add.reduceat(scores, starts, axis=1), starts, axis=0)
+        reduced = reduced / np.outer(sizes, sizes)
+    else :
+        raise ValueError("Unknown aggregation %s" % aggregation)
+
+    return np.triu(reduced, 1), node_of
+
+
+def collapse_identical_mentions_sparse(matrix, node_of, n_nodes, aggregation='max') :
+    scores = (matrix + matrix.T).tocoo()
+    rows, cols = node_of[scores.row], node_of[scores.col]
+    # Both directions are stored, keeping row < col counts every member pair once.
+    upper = rows < cols
+    rows, cols, data = rows[upper], cols[upper], scores.data[upper]
+
+    if aggregation == 'max' :
+        order = np.lexsort((cols, rows))
+        rows, cols, data = rows[order], cols[order], data[order]
+        starts = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])])
+        if len(data) > 0 :
+            data = np.maximum.reduceat(data, starts)
+        rows, cols = rows[starts], cols[starts]
+    elif aggregation == 'mean' :
+        sizes = np.bincount(node_of, minlength=n_nodes)
+        reduced = coo_matrix((data, (rows, cols)), shape=(n_nodes, n_nodes)).tocsr().tocoo()
+        rows, cols = reduced.row, reduced.col
+        data = reduced.data / (sizes[rows] * sizes[cols])
+    else :
+        raise ValueError("Unknown aggregation %s" % aggregation)
+
+    return csr_matrix((data, (rows, cols)), shape=(n_nodes, n_nodes))
+
+
+def cluster_with_sparse_linkage(matrix, threshold, method='average') :
+    '''
+    Agglomerative clustering of a sparse score matrix, merging the most similar pair of
+    clusters while its similarity is above threshold. Unscored pairs count as similarity 0, so
+    average linkage is the mean over all member pairs and complete linkage is the min score if
+    every member pair was scored (0 otherwise). Only stored edges are ever looked at, this
+    replaces the silhouette sweep for documents too large for a dense matrix.
+    '''
+    n_nodes = matrix.shape[0]
+    scores = (matrix + matrix.T).tocoo()
+
+    # neighbours[a][b] = (sum, min, count) of scores between members of clusters a and b.
+    neighbours = [dict() for _ in range(n_nodes)]
+    for i, j, score in zip(scores.row.tolist(), scores.col.tolist(), scores.data.tolist()) :
+        if i != j :
+            neighbours[i][j] = (score, score, 1)
+
+    sizes = [1] * n_nodes
+    versions = [0] * n_nodes
+    members = [[i] for i in range(n_nodes)]
+
+    def similarity(a, b) :
+        total, minimum, count = neighbours[a][b]
+        if method == 'average' :
+            return total / (sizes[a] * sizes[b])
+        if method == 'complete' :
+            return minimum if count == sizes[a] * sizes[b] else 0.0
+        raise ValueError("Unknown linkage %s" % method)
+
+    heap = []
+    for a in range(n_nodes) :
+        for b in neighbours[a] :
+            if a < b :
+                heappush(heap, (-similarity(a, b), a, b, 0, 0))
+
+    while len(heap) > 0 :
+        negative_similarity, a, b, version_a, version_b = heappop(heap)
+        if -negative_similarity <= threshold :
+            break
+        if versions[a] != version_a or versions[b] != version_b :
+            continue
+
+        # Merge the cluster with fewer neighbours into the other one.
+        if len(neighbours[a]) < len(neighbours[b]) :
+            a, b = b, a
+        del neighbours[a][b]
+        neighbours_b, neighbours[b] = neighbours[b], {}
+        for c, (total, minimum, count) in neighbours_b.items() :
+            if c == a :
+                continue
+            del neighbours[c][b]
+            if c in neighbours[a] :
+                total_a, minimum_a, count_a = neighbours[a][c]
+                total, minimum, count = total + total_a, min(minimum, minimum_a), count + count_a
+            neighbours[a][c] = neighbours[c][a] = (total, minimum, count)
+
+        sizes[a] += sizes[b]
+        members[a] += members[b]
+        members[b] = []
+        versions[a] += 1
+        versions[b] = -1
+
+        for c in neighbours[a] :
+            heappush(heap, (-similarity(a, c), a, c, versions[a], versions[c]))
+
+    # Number clusters in order of their first span.
+    roots = sorted([a for a in range(n_nodes) if len(members[a]) > 0], key=lambda a: min(members[a]))
+    labels = np.zeros(n_nodes, dtype=np.intp)
+    for label, a in enumerate(roots) :
+        labels[members[a]] = label
+    return len(roots), labels
+
 
 def cluster_with_connected_components(matrix, threshold, plot) :
     graph = ((matrix + matrix.T) > threshold).astype(int)
@@ -47,7 +274,24 @@ def map_back_to_spans(document, span_field, labels) :
 
 def do_clustering(document, span_field, coref_field, plot=True, threshold=0.5) :
     matrix = generate_matrix_for_document(document, span_field, coref_field)
-    n_clusters, cluster_labels = cluster_with_clustering(matrix, threshold, plot)
+    return do_clustering_for_matrix(document, span_field, matrix, plot=plot, threshold=threshold)
+
+def do_clustering_for_matrix(
+    document, span_field, matrix, plot=True, threshold=0.5, span_keys=None, aggregation='max', sparse_linkage='average'
+) :
+    # With span_keys, spans with the same key are clustered as one super-node.
+    # Sparse matrices (large documents) are clustered with cluster_with_sparse_linkage at threshold.
+    node_of = None
+    if span_keys is not None and len(span_keys) > 0 :
+        matrix, node_of = collapse_identical_mentions(matrix, span_keys, aggregation)
+
+    if issparse(matrix) :
+        n_clusters, cluster_labels = cluster_with_sparse_linkage(matrix, threshold, sparse_linkage)
+    else :
+        n_clusters, cluster_labels = cluster_with_clustering(matrix, threshold, plot)
+
+    if node_of is not None :
+        cluster_labels = cluster_labels[node_of]
     span_to_cluster_label = map_back_to_spans(document, span_field, cluster_labels)
 
     clusters = [{'spans' : [], 'words': set(), 'types' : set()} for _ in range(n_clusters)]
@@ -0,0 +1,94 @@
+from typing import Dict, Optional, Any
+
+import torch
+from allennlp.data.vocabulary import Vocabulary
+from allennlp.models.model import Model
+from allennlp.nn import RegularizerApplicator
+from allennlp.modules import FeedForward
+from allennlp.nn.initializers import InitializerApplicator
+from scirex.models.bert_token_embedder_modified import PretrainedBertEmbedder
+
+from scirex.metrics.thresholding_f1_metric import BinaryThresholdF1
+
+
+@Model.register("bert_coreference_bi_encoder")
+class BertCoreferenceBiEncoder(Model):
+    """
+    Bi-encoder alternative to BertCoreference. Each mention is encoded on its own (BERT pooled
+    output of [CLS] mention [SEP]), and a pair is scored by a feedforward over the symmetric
+    features [u + v, |u - v|, u * v]. At prediction time every mention is encoded once and all
+    pairs are scored from the mention embedding matrix (see ``encode_mentions`` / ``score_pairs``).
+    ``aggregate_feedforward`` takes 3 * bert hidden size inputs and outputs 2 logits.
+    """
+
+    def __init__(
+        self,
+        vocab: Vocabulary,
+        bert_model: PretrainedBertEmbedder,
+        aggregate_feedforward: FeedForward,
+        dropout: float = 0.0,
+        index: str = "bert",
+        initializer: InitializerApplicator = InitializerApplicator(),
+        regularizer: Optional[RegularizerApplicator] = None,
+    ) -> None:
+        super().__init__(vocab, regularizer)
+
+        self.bert_model = bert_model.bert_model
+
+        self._dropout = torch.nn.Dropout(p=dropout)
+
+        self._classification_layer = aggregate_feedforward
+        self._loss = torch.nn.CrossEntropyLoss()
+        self._index = index
+
+        self._f1 = BinaryThresholdF1()
+
+        initializer(self._classification_layer)
+
+    def encode_mentions(self, tokens: Dict[str, torch.LongTensor]) -> torch.Tensor:
+        input_ids = tokens[self._index]
+        token_type_ids = tokens[f"{self._index}-type-ids"]
+        input_mask = (input_ids != 0).long()
+
+        _, pooled = self.bert_model(input_ids=input_ids, token_type_ids=token_type_ids, attention_mask=input_mask)
+
+        return self._dropout(pooled)
+
+    def score_pairs(self, embeddings_1: torch.Tensor, embeddings_2: torch.Tensor) -> torch.Tensor:
+        features = torch.cat(
+            [embeddings_1 + embeddings_2, (embeddings_1 - embeddings_2).abs(), embeddings_1 * embeddings_2], dim=-1
+        )
+        return self._classification_layer(features)
+
+    def forward(
+        self,  # type: ignore
+        premise: Dict[str, torch.LongTensor],
+        hypothesis: Dict[str, torch.LongTensor],
+        label: torch.IntTensor = None,
+        metadata: Dict[str, Any] = None
+    ) -> Dict[str, torch.Tensor]:
+        # pylint: disable=arguments-differ
+        label_logits = self.score_pairs(self.encode_mentions(premise), self.encode_mentions(hypothesis))
+
+        label_probs = torch.nn.functional.softmax(label_logits, dim=-1)
+
+        output_dict = {"label_probs": label_probs[..., 1]}
+
+        if label is not None:
+            loss = self._loss(label_logits, label.long().view(-1))
+            self._f1(label_probs[..., 1], label.long().view(-1))
+            output_dict["loss"] = loss
+
+        if metadata is not None:
+            output_dict["metadata"] = metadata
+
+        return output_dict
+
+    def decode(self, output_dict: Dict[str, torch.Tensor]):
+        output_dict["label_probs"] = list(output_dict["label_probs"].detach().cpu().numpy())
+        return output_dict
+
+    def get_metrics(self, reset: bool = False) -> Dict[str, float]:
+        metrics = self._f1.get_metric(reset)
+        metrics = {k if not k.startswith("total") else ("_" + k): v for k, v in metrics.items()}
+        return metrics
@@ -1,21 +1,21 @@
 import logging
-from itertools import product, combinations
+from itertools import combinations
 from typing import Any, Dict, List, Optional
 import numpy as np
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from allennlp.data import Vocabulary
 from allennlp.models.model import Model
 from allennlp.modules import FeedForward, TimeDistributed
 from allennlp.nn import InitializerApplicator, RegularizerApplicator, util
+from allennlp.training.metrics import Average
 from overrides import overrides
 from scirex_utilities.entity_utils import used_entities
 
 from scirex.metrics.n_ary_relation_metrics import NAryRelationMetrics
 from scirex.metrics.thresholding_f1_metric import BinaryThresholdF1
 
-from collections import defaultdict
-
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
@@ -25,6 +25,12 @@ class RelationExtractor(Model):
         vocab: Vocabulary = None,
         antecedent_feedforward: FeedForward = None,
         relation_cardinality: int = 2,
+        max_clusters_per_type: int = None,
+        max_candidates_per_document: int = None,
+        factorized_scoring: bool = False,
+        relation_chunk_size: int = None,
+        paragraph_chunk_size: int = None,
+        sparse_cluster_aggregation: bool = False,
         initializer: InitializerApplicator = InitializerApplicator(),
         regularizer: Optional[RegularizerApplicator] = None,
     ) -> None:
@@ -47,8 +53,28 @@ class RelationExtractor(Model):
             tuple(e): i for i, e in enumerate(combinations(used_entities, self._relation_cardinality))
         }
 
+        ## If set, only the most salient clusters of each type (max_clusters_per_type) are used
+        ## to generate candidates, and further ones are dropped until the document has at most
+        ## max_candidates_per_document candidates. See prune_clusters.
+        self._max_clusters_per_type = max_clusters_per_type
+        self._max_candidates_per_document = max_candidates_per_document
+
+        ## If True, use get_factorized_relation_hidden (same scores, no (P, R, 4, E) tensor).
+        self._factorized_scoring = factorized_scoring
+        assert not factorized_scoring or type(antecedent_feedforward) is FeedForward, (
+            "factorized_scoring splits the layers of an allennlp FeedForward, got %s" % type(antecedent_feedforward)
+        )
+
+        ## Candidates / paragraphs scored at a time, bounds memory, see get_relation_scores.
+        self._relation_chunk_size = relation_chunk_size
+        self._paragraph_chunk_size = paragraph_chunk_size
+
+        ## If True, cluster embeddings are summed from the non zero coref labels only.
+        self._sparse_cluster_aggregation = sparse_cluster_aggregation
+
         self._binary_scores = BinaryThresholdF1()
         self._global_scores = NAryRelationMetrics()
+        self._pruned_candidates = Average()
 
         initializer(self)
 
@@ -65,36 +91,129 @@ class RelationExtractor(Model):
     def forward(self, **kwargs):
         raise NotImplementedError
 
+    @property
+    def prunes_candidates(self) -> bool:
+        return self._max_clusters_per_type is not None or self._max_candidates_per_document is not None
+
+    def count_candidates(self, type_to_clusters_map: Dict[str, List[int]]) -> int:
+        return sum(
+            int(np.prod([len(type_to_clusters_map[x]) for x in e]))
+            for e in combinations(used_entities, self._relation_cardinality)
+        )
+
+    def prune_clusters(self, type_to_clusters_map: Dict[str, List[int]], cluster_saliency: List[float]):
+        """
+        Keep the max_clusters_per_type most salient clusters of each type, then drop the least
+        salient cluster of the largest type until there are at most max_candidates_per_document
+        candidates. Kept clusters stay in their original order.
+        """
+        ranked = {
+            t: sorted(clusters, key=lambda c: -cluster_saliency[c]) for t, clusters in type_to_clusters_map.items()
+        }
+        if self._max_clusters_per_type is not None:
+            ranked = {t: clusters[: self._max_clusters_per_type] for t, clusters in ranked.items()}
+
+        if self._max_candidates_per_document is not None:
+            while self.count_candidates(ranked) > self._max_candidates_per_document:
+                largest = max(used_entities, key=lambda t: len(ranked[t]))
+                ranked[largest] = ranked[largest][:-1]
+
+        kept = {t: set(clusters) for t, clusters in ranked.items()}
+        return {t: [c for c in clusters if c in kept[t]] for t, clusters in type_to_clusters_map.items()}
+
+    def aggregate_cluster_embeddings(self, span_embeddings, coref_labels):
+        """
+        Sum of the span embeddings (P, Ns, E) of each cluster in each paragraph, weighted by
+        coref_labels (P, Ns, C), as a (P, C, E) batched matmul. With sparse_cluster_aggregation
+        only the non zero labels are gathered and added with index_add.
+        """
+        coref_labels = coref_labels.to(span_embeddings.dtype)
+        if not self._sparse_cluster_aggregation:
+            return torch.bmm(coref_labels.transpose(1, 2), span_embeddings)
+
+        n_paragraphs, _, n_clusters = coref_labels.shape
+        paragraph, span, cluster = coref_labels.nonzero(as_tuple=True)
+        weighted_spans = span_embeddings[paragraph, span] * coref_labels[paragraph, span, cluster].unsqueeze(-1)
+        sum_embeddings = span_embeddings.new_zeros((n_paragraphs * n_clusters, span_embeddings.shape[-1]))
+        sum_embeddings = sum_embeddings.index_add(0, paragraph * n_clusters + cluster, weighted_spans)
+        return sum_embeddings.view(n_paragraphs, n_clusters, -1)
+
     def generate_product(
         self,
         type_to_clusters_map: Dict[str, List[int]],
         n_true_clusters: int,
         relation_to_clusters_map: Dict[int, List[int]] = None,
     ):
+        """
+        Candidate relations (R, 4) (one cluster per type in used_entities, the type's bias
+        "cluster" for types not in the relation), their labels (R, ) and relation types (R, )
+        as LongTensors, in itertools.product order. A candidate is labelled 1 if all its
+        clusters belong to a common gold relation, checked on integer bitsets of relations.
+        """
         bias_vectors_clusters = {x: i + n_true_clusters for i, x in enumerate(used_entities)}
-        candidate_relations = []
-        candidate_relations_labels = []
-        candidate_relations_types = []
 
         if relation_to_clusters_map is None:
             relation_to_clusters_map = {}
 
-        cluster_to_relations_map = defaultdict(set)
-        for r, clist in relation_to_clusters_map.items():
-            for t in bias_vectors_clusters.values():
-                cluster_to_relations_map[t].add(r)
-            for c in clist:
-                cluster_to_relations_map[c].add(r)
+        # relation_masks[c, w] has bit b set if cluster c is in relation 64 * w + b.
+        n_clusters = max(
+            [n_true_clusters + len(used_entities)]
+            + [c + 1 for clist in type_to_clusters_map.values() for c in clist]
+            + [c + 1 for clist in relation_to_clusters_map.values() for c in clist]
+        )
+        n_words = max((len(relation_to_clusters_map) + 63) // 64, 1)
+        relation_masks = np.zeros((n_clusters, n_words), dtype=np.uint64)
+        for b, clist in enumerate(relation_to_clusters_map.values()):
+            relation_masks[list(clist), b // 64] |= np.uint64(1 << (b % 64))
+        for t in bias_vectors_clusters.values():
+            for b in range(len(relation_to_clusters_map)):
+                relation_masks[t, b // 64] |= np.uint64(1 << (b % 64))
 
+        candidate_relations = []
+        candidate_relations_types = []
         for e in combinations(used_entities, self._relation_cardinality):
-            type_lists = [type_to_clusters_map[x] if x in e else [bias_vectors_clusters[x]] for x in used_entities]
-            for clist in product(*type_lists):
-                common_relations = set.intersection(*[cluster_to_relations_map[c] for c in clist])
-                candidate_relations.append(clist)
-                candidate_relations_labels.append(1 if len(common_relations) > 0 else 0)
-                candidate_relations_types.append(self._relation_type_map[tuple(e)])
+            type_lists = [
+                np.array(type_to_clusters_map[x] if x in e else [bias_vectors_clusters[x]], dtype=np.int64)
+                for x in used_entities
+            ]
+            grid = np.stack(np.meshgrid(*type_lists, indexing="ij"), axis=-1).reshape(-1, len(used_entities))
+            candidate_relations.append(grid)
+            candidate_relations_types.append(np.full(len(grid), self._relation_type_map[tuple(e)], dtype=np.int64))
+
+        candidate_relations = np.concatenate(candidate_relations)
+        common_relations = np.bitwise_and.reduce(relation_masks[candidate_relations], axis=1)
+        candidate_relations_labels = (common_relations != 0).any(axis=-1).astype(np.int64)
+
+        return (
+            torch.from_numpy(candidate_relations),
+            torch.from_numpy(candidate_relations_labels),
+            torch.from_numpy(np.concatenate(candidate_relations_types)),
+        )
+
+    def pruned_gold_candidates(
+        self,
+        type_to_clusters_map: Dict[str, List[int]],
+        pruned_type_to_clusters_map: Dict[str, List[int]],
+        relation_to_clusters_map: Dict[int, List[int]],
+        n_true_clusters: int,
+    ) -> List[List[int]]:
+        """
+        Gold positive candidates of type_to_clusters_map that are not candidates of
+        pruned_type_to_clusters_map. Positives only use clusters of gold relations, so only
+        those are expanded.
+        """
+        relation_clusters = {c for clist in relation_to_clusters_map.values() for c in clist}
+        gold_type_to_clusters_map = {
+            t: [c for c in clusters if c in relation_clusters] for t, clusters in type_to_clusters_map.items()
+        }
+        candidates, labels, _ = self.generate_product(gold_type_to_clusters_map, n_true_clusters, relation_to_clusters_map)
 
-        return candidate_relations, candidate_relations_labels, candidate_relations_types
+        kept = [set(pruned_type_to_clusters_map[t]) | {n_true_clusters + i} for i, t in enumerate(used_entities)]
+        return [
+            relation
+            for relation, label in zip(candidates.tolist(), labels.tolist())
+            if label == 1 and not all(c in kept[k] for k, c in enumerate(relation))
+        ]
 
     def compute_representations(
         self,  # type: ignore
@@ -103,15 +222,27 @@ class RelationExtractor(Model):
         type_to_cluster_ids: Dict[str, List[int]],
         relation_to_cluster_ids: Dict[int, List[int]] = None,
         metadata: List[Dict[str, Any]] = None,
+        cluster_saliency: torch.Tensor = None,  # (C, )
     ) -> Dict[str, torch.Tensor]:
         # pylint: disable=arguments-differ
 
         if coref_labels.sum() == 0:
             return {"loss": 0.0, "metadata" : metadata}
 
+        # Pruning only restricts the candidates, every cluster keeps its type embedding.
+        candidate_type_to_cluster_ids = type_to_cluster_ids
+        if self.prunes_candidates:
+            if cluster_saliency is None:
+                # Without saliency scores, rank clusters by their number of mentions.
+                cluster_saliency = coref_labels.sum(1).sum(0)
+            candidate_type_to_cluster_ids = self.prune_clusters(type_to_cluster_ids, cluster_saliency.tolist())
+            self._pruned_candidates(
+                self.count_candidates(type_to_cluster_ids) - self.count_candidates(candidate_type_to_cluster_ids)
+            )
+
         cluster_type_embeddings = self.map_cluster_to_type_embeddings(type_to_cluster_ids)  # (1, C, E)
 
-        sum_embeddings = (span_embeddings.unsqueeze(2) * coref_labels.float().unsqueeze(-1)).sum(1)
+        sum_embeddings = self.aggregate_cluster_embeddings(span_embeddings, coref_labels)  # (P, C, E)
         length_embeddings =  (coref_labels.unsqueeze(-1).sum(1) + 1e-5)
 
         cluster_span_embeddings = sum_embeddings / length_embeddings
@@ -134,34 +265,34 @@ class RelationExtractor(Model):
         n_true_clusters = coref_labels.shape[-1]
 
         candidate_relations, candidate_relations_labels, candidate_relations_types = self.generate_product(
-            type_to_clusters_map=type_to_cluster_ids,
+            type_to_clusters_map=candidate_type_to_cluster_ids,
             relation_to_clusters_map=relation_to_cluster_ids,
             n_true_clusters=n_true_clusters,
         )
 
-        candidate_relations_tensor = torch.LongTensor(candidate_relations).to(span_embeddings.device)  # (R, 4)
-        candidate_relations_labels_tensor = torch.LongTensor(candidate_relations_labels).to(
-            span_embeddings.device
-        )  # (R, )
+        candidate_relations_tensor = candidate_relations.to(span_embeddings.device)  # (R, 4)
+        candidate_relations_labels_tensor = candidate_relations_labels.to(span_embeddings.device)  # (R, )
 
         if len(candidate_relations) == 0:
             return {"loss": 0.0, "metadata" : metadata}
 
-        all_relation_embeddings = util.batched_index_select(
-            paragraph_cluster_embeddings,
-            candidate_relations_tensor.unsqueeze(0).expand(paragraph_cluster_embeddings.shape[0], -1, -1),
-        )  # (P, R', n, E)
-
-        relation_scores, relation_logits = self.get_relation_scores(all_relation_embeddings)  # (1, R')
+        relation_scores, relation_logits = self.get_relation_scores(
+            paragraph_cluster_embeddings, candidate_relations_tensor
+        )  # (R', )
         output_dict = {}
-        output_dict["relations_candidates_list"] = candidate_relations
-        output_dict["relation_labels"] = candidate_relations_labels
-        output_dict["relation_types"] = candidate_relations_types
+        output_dict["relations_candidates_list"] = candidate_relations.tolist()
+        output_dict["relation_labels"] = candidate_relations_labels.tolist()
+        output_dict["relation_types"] = candidate_relations_types.tolist()
         output_dict["doc_id"] = metadata[0]["doc_id"]
         output_dict["metadata"] = metadata
         output_dict["relation_scores"] = relation_scores
         output_dict["relation_logits"] = relation_logits
 
+        if relation_to_cluster_ids is not None and candidate_type_to_cluster_ids is not type_to_cluster_ids:
+            output_dict["pruned_relation_candidates"] = self.pruned_gold_candidates(
+                type_to_cluster_ids, candidate_type_to_cluster_ids, relation_to_cluster_ids, n_true_clusters
+            )
+
         if relation_to_cluster_ids is not None:
             output_dict = self.predict_labels(
                 relation_scores, relation_logits, candidate_relations_labels_tensor, output_dict
@@ -169,15 +300,100 @@ class RelationExtractor(Model):
 
         return output_dict
 
-    def get_relation_scores(self, relation_embeddings):
-        # (B, NS, NS, E)
-        relation_embeddings = relation_embeddings.view(relation_embeddings.shape[0], relation_embeddings.shape[1], -1) #(P, R, E*4)
-        relation_embeddings = self._antecedent_feedforward(relation_embeddings) #(P, R, e)
-        relation_embeddings = relation_embeddings.max(0, keepdim=True)[0]
-        relation_logits = self._antecedent_scorer(relation_embeddings).squeeze(-1).squeeze(0)
+    def get_relation_scores(self, cluster_embeddings, candidate_relations):
+        """
+        Scores of candidate_relations (R, 4) given cluster_embeddings (P, C+4, E): feedforward
+        over each paragraph's cluster embeddings, max over paragraphs, then the scorer.
+
+        With relation_chunk_size / paragraph_chunk_size, candidates and paragraphs are done in
+        chunks, keeping a running max over paragraphs, so at most one (paragraph chunk,
+        relation chunk) block of hidden states exists at a time. When gradients are needed
+        the chunks are checkpointed (recomputed in backward) to keep that bound in training.
+        With factorized_scoring the slot projections are computed once, before chunking.
+        """
+        n_paragraphs, n_relations = cluster_embeddings.shape[0], candidate_relations.shape[0]
+        if self._factorized_scoring:
+            paragraph_inputs = self.get_slot_projections(cluster_embeddings)  # (P, 4, C+4, H)
+        else:
+            paragraph_inputs = cluster_embeddings
+        relation_chunk_size = self._relation_chunk_size or max(n_relations, 1)
+        paragraph_chunk_size = self._paragraph_chunk_size or n_paragraphs
+        chunked = relation_chunk_size < n_relations or paragraph_chunk_size < n_paragraphs
+
+        relation_logits = []
+        for start in range(0, n_relations, relation_chunk_size):
+            candidates = candidate_relations[start : start + relation_chunk_size]
+            relation_embeddings = None
+            for paragraph_start in range(0, n_paragraphs, paragraph_chunk_size):
+                inputs = paragraph_inputs[paragraph_start : paragraph_start + paragraph_chunk_size]
+                if chunked and torch.is_grad_enabled():
+                    chunk_embeddings = checkpoint(self.get_max_relation_hidden, inputs, candidates, use_reentrant=False)
+                else:
+                    chunk_embeddings = self.get_max_relation_hidden(inputs, candidates)
+
+                if relation_embeddings is None:
+                    relation_embeddings = chunk_embeddings
+                else:
+                    relation_embeddings = torch.max(relation_embeddings, chunk_embeddings)  # (R', e)
+
+            relation_logits.append(self._antecedent_scorer(relation_embeddings.unsqueeze(0)).squeeze(-1).squeeze(0))
+
+        relation_logits = torch.cat(relation_logits)
         relation_scores = torch.sigmoid(relation_logits)
         return relation_scores, relation_logits
 
+    def get_max_relation_hidden(self, paragraph_inputs, candidate_relations):
+        # (R, e), max over paragraphs. paragraph_inputs are slot projections with
+        # factorized_scoring, else cluster embeddings.
+        if self._factorized_scoring:
+            relation_hidden = self.get_factorized_relation_hidden(paragraph_inputs, candidate_relations)
+        else:
+            relation_hidden = self.get_gathered_relation_hidden(paragraph_inputs, candidate_relations)
+        return relation_hidden.max(0)[0]
+
+    def get_relation_hidden(self, cluster_embeddings, candidate_relations):
+        # _antecedent_feedforward output for every paragraph and candidate, (P, R, e).
+        if self._factorized_scoring:
+            return self.get_factorized_relation_hidden(self.get_slot_projections(cluster_embeddings), candidate_relations)
+        return self.get_gathered_relation_hidden(cluster_embeddings, candidate_relations)
+
+    def get_gathered_relation_hidden(self, cluster_embeddings, candidate_relations):
+        relation_embeddings = util.batched_index_select(
+            cluster_embeddings, candidate_relations.unsqueeze(0).expand(cluster_embeddings.shape[0], -1, -1)
+        )  # (P, R, n, E)
+        relation_embeddings = relation_embeddings.view(relation_embeddings.shape[0], relation_embeddings.shape[1], -1) #(P, R, E*4)
+        return self._antecedent_feedforward(relation_embeddings) #(P, R, e)
+
+    def get_slot_projections(self, cluster_embeddings):
+        """
+        The first linear layer of _antecedent_feedforward over the concatenation of the 4
+        cluster embeddings of a candidate is the sum of 4 per slot projections. These are
+        computed once per cluster, (P, 4, C+4, H) for cluster_embeddings (P, C+4, E).
+        """
+        first_layer = self._antecedent_feedforward._module._linear_layers[0]
+        slot_weights = first_layer.weight.view(first_layer.out_features, len(used_entities), -1)  # (H, 4, E)
+        return torch.einsum("pce,hke->pkch", cluster_embeddings, slot_weights)
+
+    def get_factorized_relation_hidden(self, slot_projections, candidate_relations):
+        """
+        get_relation_hidden without gathering the (P, R, 4 * E) candidate inputs: the slot
+        projections (see get_slot_projections) of each candidate are gathered and summed.
+        """
+        feedforward = self._antecedent_feedforward._module
+        first_layer = feedforward._linear_layers[0]
+
+        relation_embeddings = first_layer.bias
+        for k in range(candidate_relations.shape[-1]):
+            relation_embeddings = relation_embeddings + slot_projections[:, k, candidate_relations[:, k]]  # (P, R, H)
+        relation_embeddings = feedforward._dropout[0](feedforward._activations[0](relation_embeddings))
+
+        for layer, activation, dropout in zip(
+            feedforward._linear_layers[1:], feedforward._activations[1:], feedforward._dropout[1:]
+        ):
+            relation_embeddings = dropout(activation(layer(relation_embeddings)))
+
+        return relation_embeddings
+
     def predict_labels(self, relation_scores, relation_logits, relation_labels, output_dict):
         output_dict["loss"] = 0.0
 
@@ -199,6 +415,16 @@ class RelationExtractor(Model):
                 output_dict["doc_id"],
             )
 
+            # Gold relations dropped by prune_clusters are scored 0, ie. counted as missed.
+            pruned_candidates = output_dict.get("pruned_relation_candidates", [])
+            if len(pruned_candidates) > 0:
+                self._global_scores(
+                    pruned_candidates,
+                    [1] * len(pruned_candidates),
+                    relation_scores.new_zeros(len(pruned_candidates)),
+                    output_dict["doc_id"],
+                )
+
         return output_dict
 
     @overrides
@@ -224,4 +450,6 @@ class RelationExtractor(Model):
         metrics = {}
         global_metrics = self._global_scores.get_metric(reset)
         metrics.update({"global_" + k: v for k, v in global_metrics.items()})
+        if self.prunes_candidates:
+            metrics["pruned_candidates"] = self._pruned_candidates.get_metric(reset)
         return {"n_ary_rel_" + k: v for k, v in metrics.items()}
@@ -228,7 +228,10 @@ class ScirexModel(Model):
 
         return output_saliency
 
-    def relation_forward(self, output_span_embedding, metadata, relation_to_cluster_ids, span_cluster_labels):
+    def relation_forward(
+        self, output_span_embedding, metadata, relation_to_cluster_ids, span_cluster_labels, output_saliency=None
+    ):
+        # output_saliency of this forward pass, if already computed, ranks clusters for pruning.
         output_n_ary_relation = {"loss": 0.0}
 
         if output_span_embedding["valid"]:
@@ -245,12 +248,23 @@ class ScirexModel(Model):
                 relation_to_cluster_ids = metadata[0]["document_metadata"]["relation_to_cluster_ids"]
                 span_cluster_labels = span_cluster_labels[:, :, :n_salient_clusters]
 
+                cluster_saliency = None
+                if self._cluster_n_ary_relation.prunes_candidates:
+                    if output_saliency is None:
+                        output_saliency = self._saliency_classifier(
+                            spans=spans,
+                            span_embeddings=featured_span_embeddings,
+                            span_features=output_span_embedding["span_features"],
+                        )
+                    cluster_saliency = self.get_cluster_saliency(output_saliency["ner_probs"], span_cluster_labels)
+
                 output_n_ary_relation = self._cluster_n_ary_relation.compute_representations(
                     span_embeddings=featured_span_embeddings,
                     coref_labels=span_cluster_labels,
                     type_to_cluster_ids=type_to_cluster_ids,
                     relation_to_cluster_ids=relation_to_cluster_ids,
                     metadata=metadata,
+                    cluster_saliency=cluster_saliency,
                 )
 
         return output_n_ary_relation
@@ -283,17 +297,13 @@ class ScirexModel(Model):
                 metadata=metadata,
             )
 
-            if relation_to_cluster_ids is not None or self.prediction_mode:
-                type_to_cluster_ids = metadata[0]["document_metadata"]["type_to_cluster_ids"]
-                relation_to_cluster_ids = metadata[0]["document_metadata"]["relation_to_cluster_ids"]
-
-                output_n_ary_relation = self._cluster_n_ary_relation.compute_representations(
-                    span_embeddings=featured_span_embeddings,
-                    coref_labels=span_cluster_labels,
-                    type_to_cluster_ids=type_to_cluster_ids,
-                    relation_to_cluster_ids=relation_to_cluster_ids,
-                    metadata=metadata,
-                )
+            output_n_ary_relation = self.relation_forward(
+                output_span_embedding,
+                metadata,
+                relation_to_cluster_ids,
+                span_cluster_labels,
+                output_saliency=output_saliency,
+            )
 
         return output_saliency, output_n_ary_relation
 
@@ -305,6 +315,13 @@ class ScirexModel(Model):
         span_labels_one_hot.scatter_(-1, span_labels.unsqueeze(-1), 1)
         return span_labels_one_hot
 
+    @staticmethod
+    def get_cluster_saliency(span_saliency_probs, span_cluster_labels):
+        # Mean saliency probability of the spans of each cluster, (C, ). Only used for ranking.
+        span_cluster_labels = span_cluster_labels.float()
+        total = (span_saliency_probs.detach().unsqueeze(-1) * span_cluster_labels).sum(1).sum(0)
+        return total / (span_cluster_labels.sum(1).sum(0) + 1e-5)
+
     @staticmethod
     def _flatten_span_info(span_info_batched, span_ix):
         feature_size = span_info_batched.size(-1)
@@ -1,12 +1,62 @@
 import json
-from scirex.models.clustering.clustering import do_clustering
+from itertools import islice
+from multiprocessing import Pool
+
+import numpy as np
+from scirex.data.utils.pairwise_scores import is_pairwise_scores_file, read_pairwise_scores
+from scirex.models.clustering.clustering import (
+    do_clustering_for_matrix,
+    generate_matrix_for_document,
+    generate_matrix_from_pairs,
+)
 import tqdm
 import sys
 
+from scirex_utilities.json_utilities import LazyJsonlDict, iter_jsonl, open_jsonl
+
+
+def read_coreference_documents(coreference_scores_file) :
+    # Binary (.npz) score files already hold span and pair index arrays, jsonl ones are parsed.
+    if is_pairwise_scores_file(coreference_scores_file) :
+        for doc in read_pairwise_scores(coreference_scores_file) :
+            spans = [tuple(x) for x in doc["spans"].tolist()]
+            matrix = generate_matrix_from_pairs(len(spans), doc["pairs"], doc["scores"].astype(np.float64))
+            yield {"doc_id": doc["doc_id"], "spans": spans, "matrix": matrix}
+        return
 
-def predict(coreference_scores_file, output_file, coreference_threshold):
+    for doc in iter_jsonl(coreference_scores_file) :
+        doc["spans"] = sorted(
+            list(
+                set(
+                    [tuple(x[0]) for x in doc["pairwise_coreference_scores"]]
+                    + [tuple(x[1]) for x in doc["pairwise_coreference_scores"]]
+                )
+            )
+        )
+        doc["matrix"] = generate_matrix_for_document(doc, "spans", "pairwise_coreference_scores")
+        yield doc
+
+
+def span_keys_for_document(doc, span_predictions) :
+    # (normalized surface string, type) of each span, spans without a prediction stay apart.
+    words = span_predictions["words"]
+    span_types = {(s, e): t for s, e, t in span_predictions["ner"]}
+    return [
+        (" ".join(words[s:e]).lower(), span_types[(s, e)]) if (s, e) in span_types else (s, e)
+        for s, e in doc["spans"]
+    ]
+
+
+def predict(
+    coreference_scores_file,
+    output_file,
+    coreference_threshold,
+    span_prediction_file=None,
+    aggregation="max",
+    num_workers=1,
+):
     '''
-    coreference_scores_file (jsonl) -
+    coreference_scores_file (jsonl, or .npz written by scirex.data.utils.pairwise_scores) -
     {
         'doc_id' : str,
         'pairwise_coreference_scores' : List[(s_1, e_1), (s_2, e_2), float (3 sig. digits) in [0, 1]]
@@ -18,29 +68,85 @@ def predict(coreference_scores_file, output_file, coreference_threshold):
         'spans' : List[Tuple[int, int]]
         'clusters' : Dict[str, List[Tuple[int, int]]]
     }
+
+    With span_prediction_file (ner predictions, doc_id, words and ner fields), mentions with
+    the same lowercased string and type are collapsed into one node before clustering, their
+    pair scores aggregated by aggregation ("max" or "mean").
+
+    Documents with more than SPARSE_CLUSTERING_MIN_SPANS spans get a sparse score matrix and
+    are clustered by average linkage, merging while the score is above coreference_threshold.
+
+    With num_workers > 1, documents are clustered in a pool of worker processes (see
+    cluster_in_pool), output order is unchanged.
     '''
-    documents = [json.loads(line) for line in tqdm.tqdm(open(coreference_scores_file))]
-    for doc in documents:
-        doc["spans"] = sorted(
-            list(
-                set(
-                    [tuple(x[0]) for x in doc["pairwise_coreference_scores"]]
-                    + [tuple(x[1]) for x in doc["pairwise_coreference_scores"]]
-                )
-            )
-        )
+    span_predictions = LazyJsonlDict(span_prediction_file) if span_prediction_file is not None else None
 
-    cluster_outputs = []
-    for doc in tqdm.tqdm(documents):
-        clusters = do_clustering(
-            doc, "spans", "pairwise_coreference_scores", plot=True, threshold=coreference_threshold
-        )
-        coref_clusters = {str(i): v["spans"] for i, v in enumerate(clusters)}
+    def tasks() :
+        for doc in read_coreference_documents(coreference_scores_file) :
+            span_keys = None
+            if span_predictions is not None :
+                span_keys = span_keys_for_document(doc, span_predictions[doc["doc_id"]])
+            yield doc, coreference_threshold, span_keys, aggregation
+
+    if num_workers > 1 :
+        cluster_outputs = cluster_in_pool(tasks(), num_workers)
+    else :
+        cluster_outputs = (cluster_document(*task) for task in tasks())
+
+    with open_jsonl(output_file, "w") as f:
+        for line in tqdm.tqdm(cluster_outputs) :
+            f.write(json.dumps(line) + "\n")
+
+    if span_predictions is not None :
+        span_predictions.close()
+
+
+def cluster_document(doc, coreference_threshold, span_keys=None, aggregation="max") :
+    clusters = do_clustering_for_matrix(
+        doc,
+        "spans",
+        doc["matrix"],
+        plot=True,
+        threshold=coreference_threshold,
+        span_keys=span_keys,
+        aggregation=aggregation,
+    )
+    coref_clusters = {str(i): v["spans"] for i, v in enumerate(clusters)}
+
+    return {'doc_id' : doc['doc_id'], 'spans' : doc['spans'], 'clusters' : coref_clusters}
+
+
+def cluster_in_pool(tasks, num_workers) :
+    '''
+    cluster_document for each task in a pool of num_workers processes, yielded in task order.
+    Tasks are read in windows, the next window is clustered while the previous one is
+    consumed, so at most two windows of documents are in memory. Within a window the
+    largest documents are submitted first so they don't end up as the tail.
+    '''
+    window_size = num_workers * 4
+    tasks = iter(tasks)
+    with Pool(num_workers) as pool :
+        pending = []
+        while True :
+            window = list(islice(tasks, window_size))
+            if len(window) == 0 :
+                break
+            results = [None] * len(window)
+            for i in sorted(range(len(window)), key=lambda i: -len(window[i][0]["spans"])) :
+                results[i] = pool.apply_async(cluster_document, window[i])
+            for result in pending :
+                yield result.get()
+            pending = results
 
-        cluster_outputs.append({'doc_id' : doc['doc_id'], 'spans' : doc['spans'], 'clusters' : coref_clusters})
+        for result in pending :
+            yield result.get()
 
-    with open(output_file, "w") as f:
-        f.write("\n".join([json.dumps(line) for line in cluster_outputs]))
 
 if __name__ == '__main__' :
-    predict(sys.argv[1], sys.argv[2], float(sys.argv[3]))
\ No newline at end of file
+    predict(
+        sys.argv[1],
+        sys.argv[2],
+        float(sys.argv[3]),
+        sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != "-" else None,
+        num_workers=int(sys.argv[5]) if len(sys.argv) > 5 else 1,
+    )
@@ -15,30 +15,33 @@ from allennlp.models.archival import load_archive
 from allennlp.nn import util as nn_util
 from scirex.predictors.utils import merge_method_subrelations
 
-from scirex_utilities.json_utilities import load_jsonl, annotations_to_jsonl
+from scirex_utilities.json_utilities import LazyJsonlDict, annotations_to_jsonl, iter_jsonl, open_jsonl
 
 import logging
 logging.basicConfig(format="%(asctime)s:%(levelname)s:%(message)s", level=logging.INFO)
 
 def combine_span_and_cluster_file(span_file, cluster_file) :
-    spans = load_jsonl(span_file)
-    clusters = {item['doc_id'] :  item for item in load_jsonl(cluster_file)}
+    # Stream the span file in file order and look up each document's clusters through the
+    # byte offset index, so neither file is held in memory and the span file is read once.
+    def combined_documents(clusters) :
+        for doc in iter_jsonl(span_file) :
+            cluster_doc = clusters[doc['doc_id']]
+            if 'clusters' in cluster_doc :
+                doc['coref'] = cluster_doc['clusters']
+            else :
+                merge_method_subrelations(cluster_doc)
+                doc['coref'] = {x: v for x, v in cluster_doc['coref'].items() if len(v) > 0}
 
-    for doc in spans :
-        if 'clusters' in clusters[doc['doc_id']] :
-            doc['coref'] = clusters[doc['doc_id']]['clusters']
-        else :
-            merge_method_subrelations(clusters[doc['doc_id']])
-            doc['coref'] = {x: v for x, v in clusters[doc['doc_id']]['coref'].items() if len(v) > 0}
+            if 'n_ary_relations' in doc:
+                del doc['n_ary_relations']
 
-        if 'n_ary_relations' in doc:
-            del doc['n_ary_relations']
+            if 'method_subrelations' in doc :
+                del doc['method_subrelations']
 
-        if 'method_subrelations' in doc :
-            del doc['method_subrelations']
+            yield doc
 
-       
-    annotations_to_jsonl(spans, 'tmp_relation_42424242.jsonl')
+    with LazyJsonlDict(cluster_file) as clusters :
+        annotations_to_jsonl(combined_documents(clusters), 'tmp_relation_42424242.jsonl', sort=False)
 
 
 def predict(archive_folder, span_file, cluster_file, output_file, cuda_device):
@@ -69,7 +72,7 @@ def predict(archive_folder, span_file, cluster_file, output_file, cuda_device):
     data_iterator = DataIterator.from_params(config["validation_iterator"])
     iterator = data_iterator(instances, num_epochs=1, shuffle=False)
 
-    with open(output_file, "w") as f:
+    with open_jsonl(output_file, "w") as f:
         documents = {}
         for batch in tqdm(iterator):
             with torch.no_grad() :
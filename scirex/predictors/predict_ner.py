@@ -13,7 +13,7 @@ from allennlp.data.dataset import Batch
 from allennlp.models.archival import load_archive
 from allennlp.nn import util as nn_util
 
-from scirex_utilities.json_utilities import NumpyEncoder
+from scirex_utilities.json_utilities import NumpyEncoder, open_jsonl
 
 import logging
 
@@ -41,7 +41,7 @@ def predict(archive_folder, test_file, output_file, cuda_device):
     data_iterator = DataIterator.from_params(config["validation_iterator"])
     iterator = data_iterator(instances, num_epochs=1, shuffle=False)
 
-    with open(output_file, "w") as f:
+    with open_jsonl(output_file, "w") as f:
         documents = {}
         for batch in tqdm(iterator):
             batch = nn_util.move_to_device(batch, cuda_device)  # Put on GPU.
@@ -57,7 +57,9 @@ def predict(archive_folder, test_file, output_file, cuda_device):
             para_starts: List[int] = [int(m["start_pos_in_doc"]) for m in metadata]
             para_ends: List[int] = [int(m["end_pos_in_doc"]) for m in metadata]
             sentence_indices: List[List[Tuple[int, int]]] = [m["sentence_indices"] for m in metadata]
-            words: List[str] = [m["paragraph"] for m in metadata]
+            words: List[List[str]] = [
+                m["document_metadata"]["words"][m["start_pos_in_doc"] : m["end_pos_in_doc"]] for m in metadata
+            ]
 
             for s, e, sents in zip(para_starts, para_ends, sentence_indices):
                 assert s == sents[0][0], breakpoint()
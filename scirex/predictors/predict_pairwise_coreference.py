@@ -1,22 +1,85 @@
 #! /usr/bin/env python
 
 import json
+import logging
 import os
 from sys import argv
-from typing import List
 
 from tqdm import tqdm
 import torch
 
 from allennlp.common.util import import_submodules
 from allennlp.data import DataIterator
+from allennlp.data.iterators import BasicIterator
 from allennlp.data.dataset import Batch
 from allennlp.models.archival import load_archive
 from allennlp.nn import util as nn_util
 from scirex.data.dataset_readers.coreference_eval_reader import ScirexCoreferenceEvalReader
+from scirex.data.utils.document_cache import hash_file_content
+from scirex.data.utils.pair_score_cache import PairScoreCache
+from scirex.data.utils.pairwise_scores import PairwiseScoresWriter, is_pairwise_scores_file
+from scirex.models.coreference.bert_coreference_bi_encoder import BertCoreferenceBiEncoder
+from scirex_utilities.json_utilities import open_jsonl
 
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
-def predict(archive_folder, span_prediction_file, output_file, cuda_device):
+
+def pair_key(metadata):
+    # Normalized (premise, hypothesis) strings, as seen by the model after tokenization.
+    return " ".join(metadata["premise_tokens"]), " ".join(metadata["hypothesis_tokens"])
+
+
+def score_with_bi_encoder(model, dataset_reader, instances, cuda_device, batch_size=1000):
+    '''
+    Encode every distinct mention once, then score all pairs from the mention embedding
+    matrix. Returns (metadata, score) for each instance.
+    '''
+    metadata = [ins["metadata"].metadata for ins in instances]
+    mention_to_index = {}
+    for m in metadata:
+        for tokens in (m["premise_tokens"], m["hypothesis_tokens"]):
+            mention_to_index.setdefault(tuple(tokens), len(mention_to_index))
+
+    mention_instances = [dataset_reader.mention_to_instance(list(tokens)) for tokens in mention_to_index]
+    Batch(mention_instances).index_instances(model.vocab)
+    iterator = BasicIterator(batch_size=batch_size)
+
+    embeddings = []
+    for batch in tqdm(iterator(mention_instances, num_epochs=1, shuffle=False)):
+        with torch.no_grad() :
+            batch = nn_util.move_to_device(batch, cuda_device)
+            embeddings.append(model.encode_mentions(batch["tokens"]))
+    embeddings = torch.cat(embeddings, dim=0)
+
+    index_1 = torch.tensor([mention_to_index[tuple(m["premise_tokens"])] for m in metadata], device=embeddings.device)
+    index_2 = torch.tensor([mention_to_index[tuple(m["hypothesis_tokens"])] for m in metadata], device=embeddings.device)
+
+    probs = []
+    for start in range(0, len(metadata), batch_size):
+        with torch.no_grad() :
+            label_logits = model.score_pairs(
+                embeddings[index_1[start : start + batch_size]], embeddings[index_2[start : start + batch_size]]
+            )
+            probs += torch.nn.functional.softmax(label_logits, dim=-1)[:, 1].cpu().tolist()
+
+    return list(zip(metadata, probs))
+
+
+def predict(
+    archive_folder,
+    span_prediction_file,
+    output_file,
+    cuda_device,
+    deduplicate_pairs=True,
+    mention_blocking=False,
+    lexical_cascade=False,
+    cascade_reject_threshold=0.0,
+    cascade_accept_threshold=float("inf"),
+    score_cache_directory=None,
+    score_cache_size_mb=1024,
+    max_tokens_per_batch=25000,
+    streaming=True,
+):
     '''
     span_prediction_file (jsonl) needs atleast three fields 
         - doc_id, words: List[str], field: List[Tuple[start_index, end_index, type]]
@@ -26,6 +89,31 @@ def predict(archive_folder, span_prediction_file, output_file, cuda_device):
             'doc_id' : str,
             'pairwise_coreference_scores' : List[(s_1, e_1), (s_2, e_2), float (3 sig. digits) in [0, 1]]
         }
+    If output_file ends with .npz, the same scores are written in the binary format of
+    scirex.data.utils.pairwise_scores (float16 scores) instead.
+
+    With deduplicate_pairs, mention pairs with the same model input are scored once and the
+    score is copied to each of them.
+
+    With mention_blocking, only mention pairs sharing a MentionBlocker block are scored.
+
+    With lexical_cascade, pairs a LexicalCascade can decide from their strings get its
+    synthetic score and only the rest are scored by the model. Tune the thresholds with
+    python -m scirex.data.utils.lexical_cascade on dev data.
+
+    The model archive can be a BertCoreference (cross-encoder) or a BertCoreferenceBiEncoder,
+    which encodes each distinct mention once and scores pairs from the embeddings.
+
+    With score_cache_directory, pair scores are looked up in (and added to) a persistent
+    PairScoreCache for this model archive before running the model.
+
+    Cross-encoder pairs are batched by the archive's iterator with 1000 pairs per batch, or,
+    for a bucket_sample iterator, length bucketed into batches of at most max_tokens_per_batch
+    padded wordpieces and 1000 pairs.
+
+    With streaming, pairs are generated, scored and written one document at a time, so memory
+    is bounded by the largest document (deduplication is then per document). Otherwise all
+    pairs of the file are read and scored together.
     '''
     import_submodules("scirex")
     archive_file = os.path.join(archive_folder, "model.tar.gz")
@@ -35,41 +123,111 @@ def predict(archive_folder, span_prediction_file, output_file, cuda_device):
     config = archive.config.duplicate()
     dataset_reader_params = config["dataset_reader"]
     dataset_reader_params.pop('type')
-    dataset_reader = ScirexCoreferenceEvalReader.from_params(params=dataset_reader_params, field="ner")
-    instances = dataset_reader.read(span_prediction_file)
-
-    batch = Batch(instances)
-    batch.index_instances(model.vocab)
-
-    config['iterator'].pop('batch_size')
-    data_iterator = DataIterator.from_params(config["iterator"], batch_size=1000)
-    iterator = data_iterator(instances, num_epochs=1, shuffle=False)
+    dataset_reader = ScirexCoreferenceEvalReader.from_params(
+        params=dataset_reader_params,
+        field="ner",
+        deduplicate_pairs=deduplicate_pairs,
+        mention_blocking=mention_blocking,
+        lexical_cascade=lexical_cascade,
+        cascade_reject_threshold=cascade_reject_threshold,
+        cascade_accept_threshold=cascade_accept_threshold,
+    )
+
+    cache = None
+    if score_cache_directory is not None:
+        cache = PairScoreCache(score_cache_directory, hash_file_content(archive_file), score_cache_size_mb)
+
+    data_iterator = None
+    if not isinstance(model, BertCoreferenceBiEncoder):
+        config['iterator'].pop('batch_size')
+        config['iterator'].pop('max_tokens_per_batch', None)
+        data_iterator = DataIterator.from_params(
+            config["iterator"], batch_size=1000, max_tokens_per_batch=max_tokens_per_batch
+        )
+
+    if streaming:
+        chunks = (instances for _, instances in dataset_reader.read_documents(span_prediction_file))
+    else:
+        chunks = [dataset_reader.read(span_prediction_file)]
+
+    if is_pairwise_scores_file(output_file):
+        writer = PairwiseScoresWriter(output_file)
+        write_document = lambda x: writer.add_document(x["doc_id"], x["pairwise_coreference_scores"])
+    else:
+        writer = open_jsonl(output_file, "w")
+        write_document = lambda x: writer.write(json.dumps(x) + "\n")
+
+    with writer:
+        for instances in chunks:
+            scored = score_instances(model, dataset_reader, data_iterator, instances, cuda_device, cache)
+            for x in broadcast_scores(scored).values():
+                write_document(x)
+
+    if cache is not None:
+        cache.close()
+
+
+def score_instances(model, dataset_reader, data_iterator, instances, cuda_device, cache=None):
+    '''
+    (metadata, score) for each instance, from the lexical cascade, the score cache or the model.
+    '''
+    scored = [
+        (ins["metadata"].metadata, ins["metadata"].metadata["cascade_score"])
+        for ins in instances
+        if "cascade_score" in ins["metadata"].metadata
+    ]
+    instances = [ins for ins in instances if "cascade_score" not in ins["metadata"].metadata]
+
+    if cache is not None:
+        cached_scores = cache.get_many([pair_key(ins["metadata"].metadata) for ins in instances])
+        scored += [
+            (ins["metadata"].metadata, cached_scores[pair_key(ins["metadata"].metadata)])
+            for ins in instances
+            if pair_key(ins["metadata"].metadata) in cached_scores
+        ]
+        instances = [ins for ins in instances if pair_key(ins["metadata"].metadata) not in cached_scores]
+        logger.info("Found %d pairs in score cache, %d left to score", len(cached_scores), len(instances))
+
+    if len(instances) > 0 and isinstance(model, BertCoreferenceBiEncoder):
+        batch_scored = score_with_bi_encoder(model, dataset_reader, instances, cuda_device)
+        if cache is not None:
+            cache.put_many([(pair_key(m), p) for m, p in batch_scored])
+        scored += batch_scored
+    elif len(instances) > 0:
+        batch = Batch(instances)
+        batch.index_instances(model.vocab)
+
+        iterator = data_iterator(instances, num_epochs=1, shuffle=False)
 
-    with open(output_file, "w") as f:
-        documents = {}
         for batch in tqdm(iterator):
             with torch.no_grad() :
                 batch = nn_util.move_to_device(batch, cuda_device)  # Put on GPU.
                 pred = model(**batch)
                 decoded = model.decode(pred)
 
-            metadata = decoded["metadata"]
-            label_prob: List[float] = [float(x) for x in decoded["label_probs"]]
-            doc_ids: List[str] = [m["doc_id"] for m in metadata]
-            span_premise = [m["span_premise"] for m in metadata]
-            span_hypothesis = [m["span_hypothesis"] for m in metadata]
-            fields = [m["field"] for m in metadata]
-            assert len(set(fields)) == 1, breakpoint()
+            batch_scored = [(m, float(p)) for m, p in zip(decoded["metadata"], decoded["label_probs"])]
+            if cache is not None:
+                cache.put_many([(pair_key(m), p) for m, p in batch_scored])
+            scored += batch_scored
+
+    return scored
+
 
-            for doc_id, span_p, span_h, p in zip(doc_ids, span_premise, span_hypothesis, label_prob):
-                if doc_id not in documents:
-                    documents[doc_id] = {"doc_id": doc_id, "pairwise_coreference_scores": []}
+def broadcast_scores(scored):
+    documents = {}
+    for m, p in scored:
+        # Broadcast the score of a deduplicated instance back to every mention pair it stands for.
+        for pair in m.get("pairs", [m]):
+            assert pair["field"] == "ner", breakpoint()
+            doc_id, span_p, span_h = pair["doc_id"], pair["span_premise"], pair["span_hypothesis"]
+            if doc_id not in documents:
+                documents[doc_id] = {"doc_id": doc_id, "pairwise_coreference_scores": []}
 
-                documents[doc_id]["pairwise_coreference_scores"].append(
-                    ((span_p[0], span_p[1]), (span_h[0], span_h[1]), round(p, 4))
-                )
+            documents[doc_id]["pairwise_coreference_scores"].append(
+                ((span_p[0], span_p[1]), (span_h[0], span_h[1]), round(p, 4))
+            )
 
-        f.write("\n".join([json.dumps(x) for x in documents.values()]))
+    return documents
 
 
 def main():
@@ -77,7 +235,8 @@ def main():
     test_file = argv[2]
     output_file = argv[3]
     cuda_device = int(argv[4])
-    predict(archive_folder, test_file, output_file, cuda_device)
+    score_cache_directory = argv[5] if len(argv) > 5 else None
+    predict(archive_folder, test_file, output_file, cuda_device, score_cache_directory=score_cache_directory)
 
 
 if __name__ == "__main__":
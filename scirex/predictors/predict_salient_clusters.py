@@ -1,11 +1,13 @@
 import json
 import sys
 
+from scirex_utilities.json_utilities import LazyJsonlDict, iter_jsonl, open_jsonl
+
 def predict(clusters_file, saliency_file, output_file):
-    clusters = [json.loads(line) for line in open(clusters_file)]
-    saliency = {item["doc_id"]: item for item in [json.loads(line) for line in open(saliency_file)]}
+    clusters = iter_jsonl(clusters_file)
+    saliency = LazyJsonlDict(saliency_file)
 
-    with open(output_file, "w") as f:
+    with open_jsonl(output_file, "w") as f, saliency:
         for doc in clusters:
             sdoc = saliency[doc["doc_id"]]
             salient_spans = set([(span[0], span[1]) for span in sdoc["saliency"] if span[2] == 1])
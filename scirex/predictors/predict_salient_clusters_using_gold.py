@@ -8,8 +8,10 @@ import json
 
 import sys
 
+from scirex.data.utils.columnar_corpus import ColumnarCorpus, is_columnar_corpus
 from scirex.predictors.utils import *
 from scirex_utilities.convert_brat_annotations_to_json import load_jsonl
+from scirex_utilities.json_utilities import open_jsonl
 
 import logging
 
@@ -17,15 +19,22 @@ logging.basicConfig(format="%(asctime)s:%(levelname)s:%(message)s", level=loggin
 
 
 def predict(clusters_file, gold_file, output_file):
-    gold_data = {item["doc_id"]: item for item in load_jsonl(gold_file)}
-    for item in gold_data.values() :
-        merge_method_subrelations(item)
-        
+    # A columnar gold corpus is memory-mapped and only the documents we need get decoded.
+    columnar_gold = is_columnar_corpus(gold_file)
+    if columnar_gold:
+        gold_data = ColumnarCorpus(gold_file)
+    else:
+        gold_data = {item["doc_id"]: item for item in load_jsonl(gold_file)}
+        for item in gold_data.values() :
+            merge_method_subrelations(item)
+
     clusters_data = load_jsonl(clusters_file)
 
-    with open(output_file, "w") as f:
+    with open_jsonl(output_file, "w") as f:
         for doc in clusters_data:
             gold_doc = gold_data[doc["doc_id"]]
+            if columnar_gold:
+                merge_method_subrelations(gold_doc)
             gold_spans: List[tuple] = convert_ner_to_list(gold_doc["ner"])
             predicted_spans: List[tuple] = convert_ner_to_list(doc["spans"])
 
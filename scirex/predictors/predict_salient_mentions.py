@@ -13,6 +13,8 @@ from allennlp.data.dataset import Batch
 from allennlp.models.archival import load_archive
 from allennlp.nn import util as nn_util
 
+from scirex_utilities.json_utilities import open_jsonl
+
 import logging
 logging.basicConfig(format="%(asctime)s:%(levelname)s:%(message)s", level=logging.INFO)
 
@@ -49,7 +51,7 @@ def predict(archive_folder, test_file, output_file, cuda_device):
     data_iterator = DataIterator.from_params(config["validation_iterator"])
     iterator = data_iterator(instances, num_epochs=1, shuffle=False)
 
-    with open(output_file, "w") as f:
+    with open_jsonl(output_file, "w") as f:
         documents = {}
         for batch in tqdm(iterator):
             batch = nn_util.move_to_device(batch, cuda_device)  # Put on GPU.
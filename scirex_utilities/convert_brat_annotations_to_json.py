@@ -11,6 +11,7 @@ import pandas as pd
 import spacy
 from scirex_utilities.analyse_pwc_entity_results import *
 from scirex_utilities.entity_utils import *
+from scirex_utilities.json_utilities import open_jsonl
 from spacy.tokens import Doc
 from tqdm import tqdm
 
@@ -528,7 +529,7 @@ def _annotation_to_dict(dc):
 
 
 def annotations_to_jsonl(annotations, output_file, key="doc_id"):
-    with open(output_file, "w") as of:
+    with open_jsonl(output_file, "w") as of:
         for ann in sorted(annotations, key=lambda x: x[key]):
             as_json = _annotation_to_dict(ann)
             as_str = json.dumps(as_json, sort_keys=True)
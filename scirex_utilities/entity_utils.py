@@ -71,8 +71,9 @@ def _annotation_to_dict(dc):
         return dc
 
 import json
+from scirex_utilities.json_utilities import open_jsonl
 def annotations_to_jsonl(annotations, output_file):
-    with open(output_file, "w") as of:
+    with open_jsonl(output_file, "w") as of:
         for ann in sorted(annotations, key=lambda x: x["doc_id"]):
             as_json = _annotation_to_dict(ann)
             as_str = json.dumps(as_json, sort_keys=True)
@@ -80,7 +81,7 @@ def annotations_to_jsonl(annotations, output_file):
             of.write("\n")
 
 def load_jsonl(filename) :
-    with open(filename) as f :
+    with open_jsonl(filename) as f :
         data = [json.loads(line) for line in f] 
 
     return data
\ No newline at end of file
@@ -1,6 +1,16 @@
+import gzip
+import io
 import json
+import logging
+import os
+import shutil
+import tempfile
+from collections.abc import Mapping
+
 import numpy as np
 
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, (np.int_, np.intc, np.intp, np.int8,
@@ -14,8 +24,145 @@ class NumpyEncoder(json.JSONEncoder):
             return obj.tolist()
         return json.JSONEncoder.default(self, obj)
 
+def is_compressed(file) :
+    return file.endswith(".gz") or file.endswith(".zst")
+
+
+def open_jsonl(file, mode="r"):
+    """
+    ``open`` for jsonl files that (de)compresses on the fly by extension: ``.gz`` with gzip,
+    ``.zst`` with zstandard (optional, ``pip install zstandard``). Everything streams, no
+    temporary files. ``mode`` is "r" / "w" for text or "rb" / "wb" for bytes.
+    """
+    if not is_compressed(file):
+        return open(file, mode)
+
+    binary_mode = mode.replace("t", "").replace("b", "") + "b"
+    if file.endswith(".gz"):
+        f = gzip.open(file, binary_mode)
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstandard is needed to read or write %s, pip install zstandard" % file)
+        f = zstandard.open(file, binary_mode)
+        if "r" in binary_mode:
+            # Gives readline / iteration over lines on the decompressed stream.
+            f = io.BufferedReader(f)
+
+    return f if "b" in mode else io.TextIOWrapper(f, encoding="utf-8")
+
+
 def load_jsonl(file) :
-    return [json.loads(line) for line in open(file )]
+    with open_jsonl(file) as f :
+        return [json.loads(line) for line in f]
+
+
+def iter_jsonl(file) :
+    with open_jsonl(file) as f :
+        for line in f :
+            yield json.loads(line)
+
+
+def _jsonl_index_path(file, key) :
+    return file + "." + key + ".idx"
+
+
+def load_jsonl_offsets(file, key="doc_id"):
+    """
+    {key value: byte offset of its line} for a jsonl file. The offsets are stored in a
+    sidecar file next to it and rebuilt whenever the jsonl file's size or mtime changes.
+    """
+    stat = os.stat(file)
+    index_file = _jsonl_index_path(file, key)
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+            return index["offsets"]
+
+    offsets = {}
+    with open_jsonl(file, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                offsets[json.loads(line)[key]] = offset
+            offset += len(line)
+
+    try:
+        with open(index_file, "w") as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "offsets": offsets}, f)
+    except OSError:
+        # Read only directory, just don't persist the index.
+        pass
+
+    return offsets
+
+
+class LazyJsonlDict(Mapping):
+    """
+    Read only {key value: document} view of a jsonl file. Only the byte offsets are kept in
+    memory, each lookup seeks to the document's line and parses just that line. Lookups
+    return a fresh dict every time, so changes to it are not seen by later lookups.
+
+    For compressed files the offsets are into the decompressed stream. Lookups in file order
+    only decompress forward. The first lookup going back decompresses the whole file once
+    into a temporary file (with a warning) and seeks in that, so joins should follow file order.
+    """
+
+    def __init__(self, file, key="doc_id"):
+        self._path = file
+        self._offsets = load_jsonl_offsets(file, key)
+        self._file = open_jsonl(file, "rb")
+        self._seekable = not is_compressed(file)
+        self._position = 0
+
+    def _decompress_to_temporary_file(self):
+        logger.warning(
+            "Out of order lookup in %s, decompressing it to a temporary file. "
+            "Look up compressed files in file order (or stream them) to avoid this.",
+            self._path,
+        )
+        self._file.close()
+        self._file = tempfile.TemporaryFile()
+        with open_jsonl(self._path, "rb") as f:
+            shutil.copyfileobj(f, self._file)
+        self._seekable = True
+
+    def _seek(self, offset):
+        if not self._seekable and offset < self._position:
+            self._decompress_to_temporary_file()
+
+        if self._seekable:
+            self._file.seek(offset)
+            return
+
+        while self._position < offset:
+            chunk = self._file.read(min(offset - self._position, 1 << 20))
+            assert len(chunk) > 0, breakpoint()
+            self._position += len(chunk)
+
+    def __getitem__(self, value):
+        offset = self._offsets[value]
+        self._seek(offset)
+        line = self._file.readline()
+        self._position = offset + len(line)
+        return json.loads(line)
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 def _annotation_to_dict(dc):
     # convenience method
@@ -37,9 +184,12 @@ def _annotation_to_dict(dc):
         return dc
 
 
-def annotations_to_jsonl(annotations, output_file, key="doc_id"):
-    with open(output_file, "w") as of:
-        for ann in sorted(annotations, key=lambda x: x[key]):
+def annotations_to_jsonl(annotations, output_file, key="doc_id", sort=True):
+    # With sort=False annotations can be any iterable and are written as they come.
+    if sort:
+        annotations = sorted(annotations, key=lambda x: x[key])
+    with open_jsonl(output_file, "w") as of:
+        for ann in annotations:
             as_json = _annotation_to_dict(ann)
             as_str = json.dumps(as_json, sort_keys=True)
             of.write(as_str)
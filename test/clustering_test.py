@@ -0,0 +1,83 @@
+import unittest
+
+import numpy as np
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.sparse import csr_matrix
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.metrics import silhouette_score
+
+from scirex.models.clustering.clustering import cluster_with_clustering, cluster_with_sparse_linkage
+
+
+# Clusterings the rewritten functions must reproduce, as (n_clusters, labels) like them.
+def previous_cluster_with_clustering(matrix):
+    # Fits AgglomerativeClustering and computes the silhouette score for every n.
+    matrix = (matrix + matrix.T) + np.eye(*matrix.shape)
+    scores = []
+    for n in range(2, matrix.shape[0] if matrix.shape[0] > 2 else 3):
+        clustering = AgglomerativeClustering(n_clusters=n, linkage='complete', metric='precomputed').fit(1 - matrix)
+        if matrix.shape[0] > 2:
+            scores.append(silhouette_score(1 - matrix, clustering.labels_, metric='precomputed'))
+        else:
+            scores.append(1)
+    best_n = scores.index(max(scores)) + 2
+    clustering = AgglomerativeClustering(n_clusters=best_n, linkage='complete', metric='precomputed').fit(1 - matrix)
+    return clustering.n_clusters_, clustering.labels_
+
+
+def scipy_cluster_with_linkage(matrix, threshold, method):
+    # Linkage of 1 - scores on the dense matrix (unscored pairs have score 0), cut where the
+    # similarity reaches threshold. Labels numbered by first span.
+    matrix = matrix + matrix.T
+    i, j = np.triu_indices(matrix.shape[0], k=1)
+    tree = linkage(1 - matrix[i, j], method=method)
+    labels = fcluster(tree, 1 - threshold, criterion='distance')
+    _, first, labels = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first))
+    return len(first), order[labels]
+
+
+def random_score_matrix(rng, n_spans, n_groups):
+    # Upper triangular pair scores, high within groups of spans and low across them.
+    groups = rng.randint(n_groups, size=n_spans)
+    same_group = groups[:, None] == groups[None, :]
+    scores = np.where(
+        same_group, rng.uniform(0.5, 1.0, (n_spans, n_spans)), rng.uniform(0.0, 0.6, (n_spans, n_spans))
+    )
+    return np.triu(scores, 1)
+
+
+def assert_same_clusters(test_case, clustering, expected_clustering):
+    (n_clusters, labels), (expected_n_clusters, expected_labels) = clustering, expected_clustering
+    test_case.assertEqual(n_clusters, expected_n_clusters)
+    test_case.assertEqual(list(labels), list(expected_labels))
+
+
+class TestClusterWithClustering(unittest.TestCase):
+    def test_same_as_sklearn(self):
+        rng = np.random.RandomState(0)
+        for n_spans in [2, 3, 4, 7, 15, 40]:
+            for n_groups in [1, 3, 6]:
+                matrix = random_score_matrix(rng, n_spans, n_groups)
+                assert_same_clusters(
+                    self, cluster_with_clustering(matrix, 0.5), previous_cluster_with_clustering(matrix)
+                )
+
+
+class TestClusterWithSparseLinkage(unittest.TestCase):
+    def test_same_as_scipy_linkage(self):
+        rng = np.random.RandomState(0)
+        for n_spans in [2, 5, 20, 60]:
+            for density in [0.1, 0.5, 1.0]:
+                matrix = random_score_matrix(rng, n_spans, 4) * (rng.uniform(size=(n_spans, n_spans)) < density)
+                for method in ['average', 'complete']:
+                    for threshold in [0.2, 0.5]:
+                        assert_same_clusters(
+                            self,
+                            cluster_with_sparse_linkage(csr_matrix(matrix), threshold, method),
+                            scipy_cluster_with_linkage(matrix, threshold, method),
+                        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import random
+import unittest
+from collections import defaultdict
+from itertools import combinations, product
+
+import torch
+from allennlp.data import Vocabulary
+from allennlp.modules import FeedForward
+from allennlp.nn import Activation
+
+from scirex.models.relations.entity_relation import RelationExtractor
+from scirex_utilities.entity_utils import used_entities
+
+EMBEDDING_SIZE = 6
+
+
+def relation_extractor(relation_cardinality=4, **kwargs):
+    feedforward = FeedForward(4 * EMBEDDING_SIZE, 2, [5, 3], Activation.by_name("relu")())
+    return RelationExtractor(Vocabulary(), feedforward, relation_cardinality=relation_cardinality, **kwargs)
+
+
+# Implementations the rewritten RelationExtractor methods replaced, the tests check that
+# the rewrites give the same results on seeded random inputs.
+def previous_aggregate_cluster_embeddings(span_embeddings, coref_labels):
+    # Broadcasts to (P, Ns, C, E).
+    return (span_embeddings.unsqueeze(2) * coref_labels.to(span_embeddings.dtype).unsqueeze(-1)).sum(1)
+
+
+def previous_generate_product(model, type_to_clusters_map, n_true_clusters, relation_to_clusters_map):
+    # itertools.product over the clusters, labels from set intersections of relations.
+    bias_vectors_clusters = {x: i + n_true_clusters for i, x in enumerate(used_entities)}
+    cluster_to_relations_map = defaultdict(set)
+    for r, clist in relation_to_clusters_map.items():
+        for t in bias_vectors_clusters.values():
+            cluster_to_relations_map[t].add(r)
+        for c in clist:
+            cluster_to_relations_map[c].add(r)
+
+    candidate_relations, candidate_relations_labels, candidate_relations_types = [], [], []
+    for e in combinations(used_entities, model._relation_cardinality):
+        type_lists = [type_to_clusters_map[x] if x in e else [bias_vectors_clusters[x]] for x in used_entities]
+        for clist in product(*type_lists):
+            common_relations = set.intersection(*[cluster_to_relations_map[c] for c in clist])
+            candidate_relations.append(list(clist))
+            candidate_relations_labels.append(1 if len(common_relations) > 0 else 0)
+            candidate_relations_types.append(model._relation_type_map[tuple(e)])
+
+    return candidate_relations, candidate_relations_labels, candidate_relations_types
+
+
+def assert_all_close(test_case, actual, expected):
+    test_case.assertEqual(actual.shape, expected.shape)
+    test_case.assertTrue(torch.allclose(actual, expected, atol=1e-6), (actual, expected))
+
+
+class TestRelationPruning(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        # One span per cluster, the Method clusters 3 and 4 compete for one slot.
+        self.span_embeddings = torch.randn(1, 5, EMBEDDING_SIZE)
+        self.coref_labels = torch.eye(5, dtype=torch.long).unsqueeze(0)
+        self.type_to_cluster_ids = {"Material": [0], "Metric": [1], "Task": [2], "Method": [3, 4]}
+        self.cluster_saliency = torch.Tensor([1.0, 1.0, 1.0, 0.9, 0.1])
+
+    def compute(self, model, relation_to_cluster_ids):
+        return model.compute_representations(
+            self.span_embeddings,
+            self.coref_labels,
+            self.type_to_cluster_ids,
+            relation_to_cluster_ids,
+            metadata=[{"doc_id": "doc"}],
+            cluster_saliency=self.cluster_saliency,
+        )
+
+    def test_pruning_last_cluster(self):
+        model = relation_extractor(max_clusters_per_type=1)
+        output = self.compute(model, {0: [0, 1, 2, 3]})
+
+        self.assertEqual(output["relations_candidates_list"], [[0, 1, 2, 3]])
+        self.assertEqual(output["relation_labels"], [1])
+        self.assertEqual(output["pruned_relation_candidates"], [])
+
+    def test_pruned_gold_relations_are_missed(self):
+        model = relation_extractor(max_clusters_per_type=1)
+        output = self.compute(model, {0: [0, 1, 2, 4]})
+
+        self.assertEqual(output["relations_candidates_list"], [[0, 1, 2, 3]])
+        self.assertEqual(output["relation_labels"], [0])
+        self.assertEqual(output["pruned_relation_candidates"], [[0, 1, 2, 4]])
+
+        metrics = model._global_scores
+        self.assertEqual(metrics._candidate_labels[("doc", (0, 1, 2, 4))], 1)
+        self.assertEqual(metrics._candidate_scores[("doc", (0, 1, 2, 4))], 0.0)
+
+    def test_pruning_keeps_scores(self):
+        # Kept candidates score the same as without pruning.
+        model = relation_extractor()
+        unpruned = self.compute(model, {0: [0, 1, 2, 3]})
+        model._max_clusters_per_type = 1
+        pruned = self.compute(model, {0: [0, 1, 2, 3]})
+
+        index = unpruned["relations_candidates_list"].index([0, 1, 2, 3])
+        assert_all_close(self, pruned["relation_scores"], unpruned["relation_scores"][index : index + 1])
+
+
+class TestFactorizedScoring(unittest.TestCase):
+    def test_same_scores_as_gathered_inputs(self):
+        torch.manual_seed(0)
+        model = relation_extractor(factorized_scoring=True)
+        model.eval()
+        cluster_embeddings = torch.randn(3, 7 + 4, EMBEDDING_SIZE)
+        candidates = torch.randint(0, 7 + 4, (20, 4))
+
+        factorized = model.get_relation_hidden(cluster_embeddings, candidates)
+        model._factorized_scoring = False
+        gathered = model.get_relation_hidden(cluster_embeddings, candidates)
+
+        self.assertEqual(factorized.shape, (3, 20, 3))
+        assert_all_close(self, factorized, gathered)
+
+    def test_chunked_scores(self):
+        # Chunked scoring is checkpointed with gradients, scores and gradients must not change.
+        for factorized_scoring in [True, False]:
+            torch.manual_seed(0)
+            model = relation_extractor(factorized_scoring=factorized_scoring)
+            cluster_embeddings = torch.randn(5, 7 + 4, EMBEDDING_SIZE, requires_grad=True)
+            candidates = torch.randint(0, 7 + 4, (20, 4))
+
+            results = []
+            for chunk_sizes in [(None, None), (6, 2)]:
+                model._relation_chunk_size, model._paragraph_chunk_size = chunk_sizes
+                model.zero_grad()
+                cluster_embeddings.grad = None
+                scores, _ = model.get_relation_scores(cluster_embeddings, candidates)
+                scores.sum().backward()
+                first_layer = model._antecedent_feedforward._module._linear_layers[0]
+                results.append((scores, cluster_embeddings.grad, first_layer.weight.grad))
+
+            for unchunked, chunked in zip(*results):
+                assert_all_close(self, chunked, unchunked)
+
+
+class TestClusterAggregation(unittest.TestCase):
+    def test_same_as_broadcast(self):
+        torch.manual_seed(0)
+        for dtype in [torch.float32, torch.float64]:
+            span_embeddings = torch.randn(3, 40, EMBEDDING_SIZE, dtype=dtype)
+            coref_labels = (torch.rand(3, 40, 9) < 0.2).long()
+            expected = previous_aggregate_cluster_embeddings(span_embeddings, coref_labels)
+
+            for sparse_cluster_aggregation in [False, True]:
+                model = relation_extractor(sparse_cluster_aggregation=sparse_cluster_aggregation)
+                sum_embeddings = model.aggregate_cluster_embeddings(span_embeddings, coref_labels)
+                self.assertEqual(sum_embeddings.dtype, dtype)
+                assert_all_close(self, sum_embeddings, expected)
+
+
+class TestGenerateProduct(unittest.TestCase):
+    def test_same_as_itertools(self):
+        rng = random.Random(0)
+        for relation_cardinality in [2, 3, 4]:
+            model = relation_extractor(relation_cardinality)
+            for n_clusters in [0, 1, 6, 15]:
+                # Up to 70 relations, so relation bitsets span more than one 64 bit word.
+                for n_relations in [0, 1, 5, 70]:
+                    clusters = list(range(n_clusters))
+                    types = {c: rng.choice(used_entities) for c in clusters}
+                    type_to_clusters_map = {t: [c for c in clusters if types[c] == t] for t in used_entities}
+                    relation_to_clusters_map = {
+                        r: rng.sample(clusters, rng.randint(0, min(n_clusters, 4))) for r in range(n_relations)
+                    }
+
+                    candidates, labels, relation_types = model.generate_product(
+                        type_to_clusters_map, n_clusters, relation_to_clusters_map
+                    )
+                    expected = previous_generate_product(
+                        model, type_to_clusters_map, n_clusters, relation_to_clusters_map
+                    )
+
+                    self.assertEqual(candidates.tolist(), expected[0])
+                    self.assertEqual(labels.tolist(), expected[1])
+                    self.assertEqual(relation_types.tolist(), expected[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
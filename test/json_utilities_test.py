@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from scirex_utilities.json_utilities import LazyJsonlDict, annotations_to_jsonl
+
+
+class TestLazyJsonlDict(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.documents = [{"doc_id": "doc%d" % i, "words": ["w"] * i} for i in range(50)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_out_of_order_lookups(self):
+        for extension in [".jsonl", ".jsonl.gz"]:
+            file = os.path.join(self.directory, "documents" + extension)
+            annotations_to_jsonl(self.documents, file, sort=False)
+
+            order = ["doc10", "doc3", "doc49", "doc0", "doc10", "doc20", "doc5"]
+            with LazyJsonlDict(file) as documents:
+                if extension == ".jsonl.gz":
+                    # Only the first lookup going back decompresses, once.
+                    with self.assertLogs("scirex_utilities.json_utilities", "WARNING") as logs:
+                        looked_up = [documents[doc_id] for doc_id in order]
+                    self.assertEqual(len(logs.output), 1)
+                else:
+                    looked_up = [documents[doc_id] for doc_id in order]
+
+                self.assertEqual(looked_up, [self.documents[int(doc_id[3:])] for doc_id in order])
+                self.assertEqual(len(documents), len(self.documents))
+
+
+if __name__ == "__main__":
+    unittest.main()
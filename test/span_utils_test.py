@@ -0,0 +1,64 @@
+import random
+import unittest
+
+from allennlp.data.dataset_readers.dataset_utils.span_utils import to_bioul
+
+from scirex.data.utils.span_utils import is_same_span, is_x_in_y, spans_to_bio_tags
+
+
+def previous_spans_to_bio_tags(spans, length):
+    # The implementation spans_to_bio_tags replaced, comparing every pair of spans.
+    tag_sequence = ['O'] * length
+    for span in spans:
+        is_inner_span = False
+        for span_2 in spans:
+            if (not is_same_span(span, span_2)) and is_x_in_y(span, span_2):
+                is_inner_span = True
+
+        if is_inner_span:
+            continue
+
+        start, end, label = span
+        tag_sequence[start] = 'B-' + label
+        for ix in range(start + 1, end):
+            tag_sequence[ix] = 'I-' + label
+
+    return to_bioul(tag_sequence, encoding='BIO')
+
+
+def tags_or_error(function, spans, length):
+    # Partially overlapping spans make to_bioul raise, both implementations must agree on that too.
+    try:
+        return function(spans, length)
+    except Exception as e:  # pylint: disable=broad-except
+        return type(e).__name__
+
+
+class TestSpansToBioTags(unittest.TestCase):
+    def test_nested_spans_are_dropped(self):
+        spans = [(0, 4, 'Method'), (1, 2, 'Task'), (5, 6, 'Metric')]
+        self.assertEqual(
+            spans_to_bio_tags(spans, 7), ['B-Method', 'I-Method', 'I-Method', 'L-Method', 'O', 'U-Metric', 'O']
+        )
+
+    def test_same_as_previous_implementation(self):
+        rng = random.Random(42)
+        labels = ['Method', 'Metric', 'Task', 'Material']
+        for _ in range(2000):
+            length = rng.randint(1, 40)
+            spans = []
+            for _ in range(rng.randint(0, 15)):
+                start = rng.randrange(length)
+                end = rng.randint(start + 1, min(length, start + 8))
+                spans.append((start, end, rng.choice(labels)))
+
+            # Duplicate boundaries with different labels are part of the contract too.
+            if spans and rng.random() < 0.3:
+                s, e, _ = rng.choice(spans)
+                spans.insert(rng.randrange(len(spans) + 1), (s, e, rng.choice(labels)))
+
+            self.assertEqual(
+                tags_or_error(spans_to_bio_tags, spans, length),
+                tags_or_error(previous_spans_to_bio_tags, spans, length),
+                spans,
+            )